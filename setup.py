@@ -29,7 +29,7 @@ class PyTest(TestCommand):
         sys.exit(errno)
 
 exec(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src','streamutils','version.py')).read())
-deps=['six>=1.4.1', 'setuptools']
+deps=['six>=1.4.1']
 if version[0]==2 and version[1] < 7:  # version_info is a tuple in python2.6
     deps.append('ordereddict')
     deps.append('counter')
@@ -48,9 +48,13 @@ setup(
     extras_require={
         'deps': deps,
         'lzma': deps + lzmadeps,
+        'numpy': deps + ['numpy'],
     },
-    tests_require=deps+lzmadeps+['pytest>=2.3.4', 'pytest-cov'],
+    tests_require=deps+lzmadeps+['numpy', 'pytest>=2.3.4', 'pytest-cov'],
     cmdclass = {'test': PyTest},
+    entry_points={
+        'console_scripts': ['streamutils = streamutils.__main__:main'],
+    },
     long_description=open(os.path.join(os.path.dirname(__file__), 'README.rst')).read(),
     classifiers=[
         'Development Status :: 3 - Alpha',
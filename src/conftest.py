@@ -0,0 +1,5 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 6): # streamutils.aio uses asynchronous generators
+    collect_ignore.append('streamutils/aio.py')
@@ -25,29 +25,30 @@ A few things to note as you read the documentation and source code for streamuti
 
 from __future__ import print_function, division#, unicode_literals
 
-from pkg_resources import parse_version 
 import six
-if parse_version(six.__version__) < parse_version('1.4.0'):  #pragma: no cover
+if tuple(int(part) for part in six.__version__.split('.')[:2]) < (1, 4):  #pragma: no cover
     raise ImportError('six version >= 1.4.0 required')
 
-from six import StringIO, string_types, integer_types, MAXSIZE, PY2, PY3
+from six import string_types, integer_types, MAXSIZE, PY2, PY3, reraise, unichr
 from six.moves import reduce, map, filter, filterfalse, zip   # These work - moves is a fake module
-from six.moves.urllib.parse import urlparse
-from six.moves.urllib.request import urlopen
 
-import re, time, subprocess, os, glob, locale, shlex, sys, codecs, inspect, heapq, bz2, gzip
+# Modules that only some stages need (e.g. subprocess, urllib, gzip, bz2, heapq) are imported by those stages, so that
+# importing streamutils stays quick for short-lived scripts
+import re, time, math, os, glob, sys, threading
 
-from io import open, TextIOWrapper
+from io import open, TextIOWrapper, BufferedReader, BufferedWriter, RawIOBase
 from contextlib import closing, contextmanager
 
-from collections import Iterable, Callable, Iterator, deque, Mapping, Sequence, defaultdict
+from collections import Iterable, Callable, Iterator, deque, Mapping, Sequence, defaultdict, namedtuple
 try:
     from collections import OrderedDict, Counter
 except ImportError: # pragma: no cover
     from ordereddict import OrderedDict #To use OrderedDict backport
     from counter import Counter         #To use Counter backport
-from itertools import chain as ichain, islice, count as icount, takewhile as itakewhile, dropwhile as idropwhile, groupby as igroupby
+from itertools import chain as ichain, islice, repeat, count as icount, takewhile as itakewhile, dropwhile as idropwhile, groupby as igroupby
 from functools import update_wrapper, partial
+from operator import methodcaller, itemgetter
+from datetime import date, datetime, timedelta
 
 from .version import __version__
 
@@ -76,10 +77,16 @@ class Connector(Iterable):
         #!/usr/bin/env python
 
         """
-        return Connector(update_wrapper(partial(self.func, *args, **kwargs), self.func), self.tokenskw)
+        return type(self)(update_wrapper(partial(self.func, *args, **kwargs), self.func), self.tokenskw)
 
     def __iter__(self):
-        it=self.func()
+        profiler=getattr(_profiling, 'profile', None)
+        stage=None if profiler is None else profiler.enter(self)
+        if stage is None:
+            it=self.func()
+        else:
+            with stage.timing():
+                it=self.func()
         if isinstance(it, Iterator):
             pass # Function returned a generator (or similar)
         elif isinstance(it, Iterable):
@@ -88,9 +95,16 @@ class Connector(Iterable):
             it=it.__iter__() #Function returned an iterable duck
         else:  #pragma: no cover
             raise TypeError('functions wrapped in Connectors must be either generators or return Iterators or Iterables (got %s)' % type(iter))
+        if stage is not None:
+            it=_ProfiledIterator(it, stage)
         self.it=it
         return self.it
 
+    def __aiter__(self):
+        """Allows a pipeline to be iterated over with ``async for`` on python 3.6+ (see :py:mod:`streamutils.aio`)"""
+        from .aio import aiterate
+        return aiterate(self)
+
     def __or__(self, other):
         if isinstance(other, Connector) or isinstance(other, Terminator):
             return other.__ror__(self)
@@ -105,17 +119,31 @@ class Connector(Iterable):
         if not hasattr(self.func, 'keywords'): # We've never been called, so func isn't a partial
             self.func=update_wrapper(partial(self.func, **{self.tokenskw: other}), self.func)
         self.func.keywords[self.tokenskw]=other
+        size=other.batchsize if isinstance(other, Connector) else None
+        if size and self.func.func not in (batched.func, unbatched.func):
+            self.func=_batchstage(self.func, self.tokenskw, size)
+            self.tokenskw='tokens'
         if self.func.keywords.pop('end', False):
             with closing(self):
                 return list(self.func())
         else:
             return self
 
+    @property
+    def batchsize(self):
+        """The number of tokens in each batch if this Connector passes on batches of tokens (see ``batched``), else ``None``"""
+        if not isinstance(self.func, partial):
+            return None
+        elif self.func.func is batched.func:
+            return self.func.keywords.get('n', self.func.args[0] if self.func.args else batched.func.__defaults__[0])
+        else:
+            return self.func.keywords.get('batchsize')
+
     def __gt__(self, other):
-        return self | smap(lambda x: x if x.endswith('\n') else x+'\n') | write(other, mode='wt') # without \n, no newline is added to the end of each token
+        return self | write(other, mode='wt', newlines=True) # without \n, no newline is added to the end of each token
         
     def __rshift__(self, other):
-        return self | smap(lambda x: x if x.endswith('\n') else x+'\n') | write(other, mode='at') # without \n, no newline is added to the end of each token
+        return self | write(other, mode='at', newlines=True) # without \n, no newline is added to the end of each token
 
     def __getattr__(self, name):
         """Ensures that docstrings from wrapped function are returned, not Terminator"""
@@ -126,13 +154,15 @@ class Connector(Iterable):
             #print('Generator for %s closing' % self.func.__name__)
             try:        # Close my generator
                 self.it.close()
-            finally:    #Close the previous generator if there is one
-                if hasattr(self.func, 'keywords'): 
+            finally:    #Close the previous generator if there is one (unless the function closes it itself)
+                if hasattr(self.func, 'keywords') and self.func.func not in _closestokens:
                     tokens=self.func.keywords.get(self.tokenskw, None)
                     if tokens and hasattr(tokens, 'close'):
                         tokens.close()
 
 class Terminator(Callable):
+    fusion=True # Fuse adjacent per-token stages when the pipeline is closed (see fuse)
+
     def __init__(self, func, tokenskw='tokens'):
         self.func=func
         self.tokenskw=tokenskw
@@ -140,8 +170,21 @@ class Terminator(Callable):
     def __ror__(self, other):
         if not (isinstance(other, Iterable)):
             raise NotImplementedError('Cannot compose a Connector with a %s' % type(other)) #pragma: no cover
+        func=self.func
+        if isinstance(other, Connector) and other.batchsize:
+            raw=getattr(func, 'func', func)
+            if raw in _batchterminators:
+                func=partial(_batchterminators[raw], *getattr(func, 'args', ()), **getattr(func, 'keywords', {}))
+            else:
+                other=Connector(_unbatch)(tokens=other)
+        profiler=getattr(_profiling, 'profile', None)
+        if Terminator.fusion and profiler is None:
+            other=fuse(other)
         try:
-            return self.func(**{self.tokenskw: _wrapInIterable(other)})
+            if profiler is not None:
+                with profiler.timing(self, other):
+                    return func(**{self.tokenskw: _wrapInIterable(other)})
+            return func(**{self.tokenskw: _wrapInIterable(other)})
         finally:
             if other and hasattr(other, 'close'):
                 other.close()
@@ -154,22 +197,34 @@ class Terminator(Callable):
         """Ensures that docstrings from wrapped function are returned, not Terminator"""
         return getattr(self.func, name)
 
+_nothing = object() # Sentinel for when there's no token to return
+
+def _addnewline(token):
+    newline=b'\n' if isinstance(token, bytes) else '\n'
+    return token if token.endswith(newline) else token+newline
+
 @contextmanager
 def _noopcontext(arg):
     '''Dummy context manager that can be used in a with block without actually doing anything'''
     yield arg
 
+def _urlopen(url):
+    """Opens ``url`` with :py:func:`urllib.request.urlopen` (imported on first use, as it is slow to import)"""
+    from six.moves.urllib.request import urlopen
+    return urlopen(url)
+
 @contextmanager
 def _wrappedopen(openfunc, fname, encoding, mode=True):
     #Horrible special-cased hacks
-    if PY3 and openfunc==urlopen: # pragma: no cover
-        with urlopen(fname) as f:
+    if PY3 and openfunc==_urlopen: # pragma: no cover
+        with _urlopen(fname) as f:
             with TextIOWrapper(f, encoding=encoding) as t:
                 yield t
     elif PY3 and sys.version_info.minor>=3: # pragma: no cover
         with openfunc(fname, mode='rt', encoding=encoding) as f:
             yield f
-    elif openfunc==urlopen or PY2 and sys.version_info[1]==6 and openfunc==gzip.open:
+    elif openfunc==_urlopen or PY2 and sys.version_info[1]==6 and openfunc.__module__=='gzip':
+        import codecs, locale
         with closing(openfunc(fname)) as f:
             yield codecs.getreader(encoding or locale.getpreferredencoding())(f)
     else:
@@ -189,48 +244,316 @@ def _wrappedopen(openfunc, fname, encoding, mode=True):
             with TextIOWrapper(fa, encoding=encoding) as t:
                 yield t
 
+class _Prefetcher(RawIOBase):
+    '''
+    A raw stream that reads blocks from a file object (typically one that decompresses the file) in a background
+    thread, keeping up to ``depth`` blocks ready in a bounded queue. :py:mod:`zlib`, :py:mod:`bz2` and :py:mod:`lzma`
+    release the GIL while they decompress, so decompression runs alongside the pipeline processing the lines
+    '''
+    def __init__(self, f, depth=4, blocksize=1<<20):
+        from six.moves import queue
+        import threading
+        self.queue=queue.Queue(depth)
+        self.stopping=threading.Event()
+        self.f=f
+        self.block, self.pos, self.eof=b'', 0, False
+        self.thread=threading.Thread(target=self._fill, args=(f, blocksize))
+        self.thread.daemon=True
+        self.thread.start()
+
+    def _fill(self, f, blocksize):
+        try:
+            block=True
+            while block and not self.stopping.is_set():
+                block=f.read(blocksize)
+                self._put(block)
+        except Exception:
+            self._put(sys.exc_info())
+
+    def _put(self, item):
+        from six.moves import queue
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def readinto(self, b):
+        while self.pos>=len(self.block):
+            if self.eof:
+                return 0
+            item=self.queue.get()
+            if isinstance(item, tuple):
+                reraise(*item)
+            self.block, self.pos, self.eof=item, 0, not item
+        n=min(len(b), len(self.block)-self.pos)
+        b[:n]=memoryview(self.block)[self.pos:self.pos+n]
+        self.pos+=n
+        return n
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        RawIOBase.close(self)
+
+@contextmanager
+def _prefetched(openfunc, fname, encoding=None, binary=False, depth=4):
+    r'''
+    Opens a file with ``openfunc`` and reads (and decompresses) it in a background thread, buffering up to ``depth``
+    blocks ahead of the reader. Lines are decoded with ``encoding`` unless ``binary`` is True
+
+    >>> import gzip
+    >>> with _prefetched(gzip.open, 'examples/passwd.gz', binary=True) as f:
+    ...     f.readline()==b'root:x:0:0:root:/root:/bin/bash\n'
+    True
+    '''
+    with closing(openfunc(fname, mode='rb')) as f:
+        with closing(BufferedReader(_Prefetcher(f, depth))) as buffered:
+            if binary:
+                yield buffered
+            else:
+                with TextIOWrapper(buffered, encoding=encoding) as t:
+                    yield t
+
+class _BZ2Streams(RawIOBase):
+    '''
+    A raw stream that decompresses every bzip2 stream in a file one after the other, for versions of python whose
+    :py:class:`bz2.BZ2File` stops at the end of the first one (files written by ``bzwrite`` or ``pbzip2`` are made of
+    several streams)
+    '''
+    def __init__(self, fname, blocksize=1<<16):
+        import bz2
+        self.f=open(fname, 'rb')
+        self.decompressor=bz2.BZ2Decompressor()
+        self.blocksize=blocksize
+        self.block, self.pos, self.rest=b'', 0, b''
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def readinto(self, b):
+        import bz2
+        while self.pos>=len(self.block):
+            data=self.rest or self.f.read(self.blocksize)
+            if not data:
+                return 0
+            try:
+                self.block, self.pos=self.decompressor.decompress(data), 0
+            except EOFError: # The last stream ended exactly at the end of the data read before
+                self.decompressor=bz2.BZ2Decompressor()
+                self.block, self.pos=self.decompressor.decompress(data), 0
+            self.rest=self.decompressor.unused_data
+            if self.rest: # The stream has ended, and the next one has started
+                self.decompressor=bz2.BZ2Decompressor()
+        n=min(len(b), len(self.block)-self.pos)
+        b[:n]=memoryview(self.block)[self.pos:self.pos+n]
+        self.pos+=n
+        return n
+
+    def close(self):
+        self.f.close()
+        RawIOBase.close(self)
+
+def _bz2open(fname, mode='rb', **kwargs):
+    """Opens a bzip2 file with :py:func:`bz2.open`, or to read all of the streams in it where :py:mod:`bz2` can't"""
+    import bz2
+    if PY3 and sys.version_info.minor>=3:
+        return bz2.open(fname, mode=mode, **kwargs)
+    return BufferedReader(_BZ2Streams(fname))
+
+class _Compressor(RawIOBase):
+    '''
+    A raw stream that cuts what is written to it into blocks of ``blocksize`` bytes and compresses each block into an
+    independent gzip member (or bzip2 or xz stream) in a pool of ``threads`` background threads. Up to twice as many
+    blocks as there are threads are queued up, and compressed blocks are written to ``f`` in order. :py:mod:`zlib`,
+    :py:mod:`bz2` and :py:mod:`lzma` release the GIL while they compress, so compression runs alongside the pipeline
+    producing the lines
+    '''
+    def __init__(self, f, compress, threads=1, blocksize=1<<20, closefile=True):
+        from multiprocessing.pool import ThreadPool
+        self.pool=ThreadPool(threads)
+        self.pending=deque()
+        self.depth=2*threads
+        self.f, self.compress, self.blocksize, self.closefile=f, compress, blocksize, closefile
+        self.block=bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.block+=b
+        while len(self.block)>=self.blocksize:
+            self._submit(bytes(self.block[:self.blocksize]))
+            del self.block[:self.blocksize]
+        return len(b)
+
+    def _submit(self, block):
+        if len(self.pending)>=self.depth:
+            self.f.write(self.pending.popleft().get())
+        self.pending.append(self.pool.apply_async(self.compress, (block, )))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.block:
+                self._submit(bytes(self.block))
+                self.block=bytearray()
+            while self.pending:
+                self.f.write(self.pending.popleft().get())
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            if self.closefile:
+                self.f.close()
+            else:
+                self.f.flush()
+            RawIOBase.close(self)
+
+def _encoding(encoding):
+    '''Returns the encoding to use to open a file if none is supplied'''
+    encoding=encoding or sys.getdefaultencoding()
+    return 'utf-8' if encoding=='ascii' else encoding
+
+def _openfunc(fname):
+    """Returns the function to use to open a file, which depends on whether its extension says it's compressed"""
+    ext=os.path.splitext(fname)[1]
+    if ext in ['.gz', '.gzip']:
+        import gzip
+        return gzip.open
+    elif ext in ['.bz2', ]:
+        return _bz2open
+    elif ext in ['.xz', ]:
+        return _lzma().open
+    else:
+        return open
+
+def _lzma():
+    """Returns the :py:mod:`lzma` module (or its backport on python 2)"""
+    try:
+        import lzma
+    except:
+        try:
+            from backports import lzma
+        except: # pragma: no cover
+            print('lzma module required to open .xz files - try installing backports.lzma')
+            raise
+    return lzma
+
+def _gzipblock(level, data):
+    """Compresses ``data`` into a complete gzip member (concatenated members make a valid gzip file)"""
+    import zlib
+    compressor=zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    return compressor.compress(data)+compressor.flush()
+
+def _bz2block(level, data):
+    """Compresses ``data`` into a complete bzip2 stream (concatenated streams make a valid bzip2 file)"""
+    import bz2
+    return bz2.compress(data, level)
+
+def _xzblock(level, data):
+    """Compresses ``data`` into a complete xz stream (concatenated streams make a valid xz file)"""
+    return _lzma().compress(data, preset=level)
+
+# extension: (function to compress a block, default level, default blocksize)
+_compressors={'.gz': (_gzipblock, 9, 1<<20), '.gzip': (_gzipblock, 9, 1<<20), '.bz2': (_bz2block, 9, 900000),
+              '.xz': (_xzblock, 6, 1<<22)}
+
+def _compressedopen(fname, ext, mode='wt', encoding=None, level=None, threads=None, blocksize=None, newline=None):
+    """
+    Opens ``fname`` (a filename, or a binary file-like object) to write to it compressed according to ``ext``, with
+    blocks compressed in ``threads`` background threads by a :py:class:`_Compressor`
+    """
+    import multiprocessing
+    compress, defaultlevel, defaultblocksize=_compressors[ext]
+    if isinstance(fname, string_types):
+        f, closefile=open(fname, 'ab' if 'a' in mode else 'wb'), True
+    else:
+        if fname is None:
+            sys.stdout.flush()
+        f, closefile=fname or getattr(sys.stdout, 'buffer', sys.stdout), False
+    raw=_Compressor(f, partial(compress, defaultlevel if level is None else level),
+                    threads or multiprocessing.cpu_count(), blocksize or defaultblocksize, closefile)
+    buffered=BufferedWriter(raw, 1<<16)
+    return buffered if 'b' in mode else TextIOWrapper(buffered, encoding=encoding, newline=newline)
+
 @contextmanager            
-def _eopen(fname, encoding=None):
+def _eopen(fname, encoding=None, binary=False, prefetch=0):
     '''
     Tries to guess what encoding to use to open a file based on first few lines. Supports xml and python
     declaration as per http://www.python.org/dev/peps/pep-0263/
 
     Can transparently read from gzip, bzip or xz files (with backports.lzma if necessary), but then encoding support is dependent on 
-    underlying python support (2.x does not support encoding)
+    underlying python support (2.x does not support encoding). If binary is True, the file is opened without decoding it,
+    so iterating through it yields ``bytes``. If prefetch is set, local files are read (and decompressed) in a background
+    thread that buffers up to ``prefetch`` blocks ahead of the reader
     TODO: use _getNewlineReadable to support encoding
     '''
 
-    encoding=encoding or sys.getdefaultencoding()
-    encoding='utf-8' if encoding=='ascii' else encoding
+    encoding=_encoding(encoding)
 
     if re.search('^[a-z+]+[:][/]{2}', fname):
-        with _wrappedopen(urlopen, fname, encoding, mode=False) as f:
+        with closing(_urlopen(fname)) if binary else _wrappedopen(_urlopen, fname, encoding, mode=False) as f:
             yield f
     else:
-        ext=os.path.splitext(fname)[1]
-        if ext in ['.gz', '.gzip']:
-            openfunc=gzip.open
-        elif ext in ['.bz2', ]:
-            openfunc=bz2.BZ2File if not PY3 or sys.version_info.minor<3 else bz2.open
-        elif ext in ['.xz', ]:
-            try:
-                import lzma
-            except:
-                try:
-                    from backports import lzma
-                except: # pragma: no cover
-                    print('lzma module required to open .xz files - try installing backports.lzma')
-                    raise
-            openfunc=lzma.open
-        else:
-            openfunc=open
-        if not encoding and os.path.splitext(fname) in ['.rb', 'py']:
+        openfunc=_openfunc(fname)
+        if not encoding and not binary and os.path.splitext(fname) in ['.rb', 'py']:
             with _wrappedopen(openfunc, fname, encoding) as f:
                 encoding=head(tokens=f, n=2) | search(r'coding[:=]\s*"?([-\w.]+)"?', 1) | first()
         #print('Opening file %s with encoding %s' % (fname, encoding))
-        with _wrappedopen(openfunc, fname, encoding) as f:
+        if prefetch:
+            opener=_prefetched(openfunc, fname, encoding, binary, prefetch)
+        else:
+            opener=closing(openfunc(fname, mode='rb')) if binary else _wrappedopen(openfunc, fname, encoding)
+        with opener as f:
             yield f
 
+def _filesize(name):
+    """Returns the size of a local file, or ``None`` if it isn't one"""
+    try:
+        return os.path.getsize(name) if not re.search('^[a-z+]+[:][/]{2}', name) else None
+    except (IOError, OSError, TypeError):
+        return None
+
+def _fileposition(f):
+    """Returns how far through the (compressed) file underlying an open file object it has been read, or ``None``"""
+    try:
+        return os.lseek(f.fileno(), 0, os.SEEK_CUR)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+def _readfiles(files, opener, progress=None, name='read', skip=0):
+    """
+    Yields the lines of each of the files in turn (after skipping ``skip`` lines) using ``opener`` to open each one,
+    reporting progress if ``progress`` is set
+    """
+    meter=_Progress(name, progress, files=files) if progress else None
+    try:
+        for fname in files:
+            with opener(fname) as f:
+                lines=islice(f, skip, None) if skip else f
+                if meter is None:
+                    for line in lines:
+                        yield line
+                else:
+                    meter.file=f
+                    for line in lines:
+                        yield meter.count(line)
+                    meter.filedone(fname)
+    finally:
+        if meter is not None:
+            meter.finish()
+
 def _groupstodict(match, group, names, inject={}):
     """
 
@@ -326,7 +649,8 @@ def _ntodict(results, n, names, inject={}):
                 return results
 
 __test__ = {}
-__all__ = ['connector', 'terminator', 'merge']
+__all__ = ['connector', 'terminator', 'merge', 'setpatterncache', 'patterncacheinfo', 'profile', 'Accumulator', 'Count', 'Sum',
+           'Max', 'Min', 'Bag', 'CountBy', 'NLargest', 'NSmallest', 'SumBy', 'MeanBy']
 
 def connector(func):
     '''
@@ -381,34 +705,656 @@ def _wrapInIterable(item):
     else:
         return [item]
 
+class _PatternCache(object):
+    """
+    A thread-safe least-recently-used cache of compiled regexps, keyed by pattern and flags, so that pipelines that are
+    built over and over again don't need to compile their patterns each time (and don't thrash :py:mod:`re`'s own
+    cache if they use more patterns than it holds)
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize=maxsize
+        self.patterns=OrderedDict()
+        self.lock=threading.Lock()
+        self.hits=self.misses=0
+
+    def compile(self, pattern, flags=0):
+        if not isinstance(pattern, string_types) and not isinstance(pattern, bytes): # Already compiled
+            if flags: #pragma: no cover
+                raise ValueError('Cannot pass flags with a compiled pattern')
+            return pattern
+        key=(type(pattern), pattern, flags)
+        with self.lock:
+            if key in self.patterns:
+                self.hits+=1
+                compiled=self.patterns[key]=self.patterns.pop(key) # Move it to the most recently used end
+                return compiled
+            self.misses+=1
+        compiled=re.compile(pattern, flags)
+        if self.maxsize!=0:
+            with self.lock:
+                self.patterns[key]=compiled
+                while self.maxsize is not None and len(self.patterns)>self.maxsize:
+                    self.patterns.popitem(last=False)
+        return compiled
+
+_patterns = _PatternCache()
+_compile = _patterns.compile
+
+PatternCacheInfo = namedtuple('PatternCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+def setpatterncache(maxsize=1024):
+    """
+    Empties the cache that ``search``, ``matches``, ``nomatch``, ``words``, ``matchesany`` and ``searchany`` use to
+    avoid compiling the same regexp each time a pipeline is built, and sets how many compiled patterns it holds (see
+    ``patterncacheinfo``)
+
+    :param maxsize: The number of patterns to keep, dropping the least recently used first (``None`` for no limit, ``0``
+        to turn off caching)
+    """
+    with _patterns.lock:
+        _patterns.maxsize=maxsize
+        _patterns.patterns.clear()
+        _patterns.hits=_patterns.misses=0
+
+def patterncacheinfo():
+    """
+    Returns statistics about the cache of compiled regexps (see ``setpatterncache``) as a ``namedtuple`` of ``hits``,
+    ``misses``, ``maxsize`` and ``currsize``. Stages also accept patterns that have already been compiled with
+    :py:func:`re.compile`, which aren't cached
+
+    >>> from streamutils import *
+    >>> setpatterncache(maxsize=2)
+    >>> for pattern in ['Happy', 'Sneezy', 'Happy', 'Dopey']:
+    ...     ['Happy', 'Sneezy', 'Dopey'] | matches(pattern) | first()
+    'Happy'
+    'Sneezy'
+    'Happy'
+    'Dopey'
+    >>> patterncacheinfo()
+    PatternCacheInfo(hits=1, misses=3, maxsize=2, currsize=2)
+    >>> setpatterncache()
+    """
+    with _patterns.lock:
+        return PatternCacheInfo(_patterns.hits, _patterns.misses, _patterns.maxsize, len(_patterns.patterns))
+
+_kernels = {}
+_fused = {}
+_closestokens = set() # Functions wrapped by Connectors that close their own tokens (e.g. from a thread that reads them)
+
+def _kernel(connected):
+    """
+    Decorator used to register a per-token kernel for a ``Connector`` so that it can be fused with its neighbours by
+    :py:func:`fuse` or run over a whole batch of tokens (see ``batched``). The kernel is called with the same arguments as the function wrapped by the ``Connector`` (less
+    ``tokens``) and returns a ``list`` of ``(kind, func)`` steps, where ``kind`` is one of ``'map'``, ``'filter'`` or
+    ``'filterfalse'``, or ``None`` if the stage can't be fused given those arguments
+
+    :param connected: The ``Connector`` the kernel is equivalent to
+    """
+    def register(kernel):
+        _kernels[connected.func]=kernel
+        return kernel
+    return register
+
+def _compilesteps(steps):
+    """
+    Compiles a list of ``(kind, func)`` steps into a single generator function that runs all of them in one loop, so
+    that each token costs one generator handoff rather than one per stage. Compiled loops are cached by shape
+
+    >>> fused=_compilesteps([('map', str.strip), ('filter', None), ('filterfalse', str.isdigit), ('map', str.upper)])
+    >>> list(fused(tokens=[' a ', '  ', ' 1 ', 'b']))
+    ['A', 'B']
+    """
+    kinds=tuple(kind for kind, func in steps)
+    if kinds not in _fused:
+        funcs=['f%d' % i for i in range(len(kinds))]
+        lines=['def fused(%s):' % ', '.join(funcs+['tokens']), '    for token in tokens:']
+        for func, kind in zip(funcs, kinds):
+            if kind=='map':
+                lines.append('        token=%s(token)' % func)
+            elif kind=='filter':
+                lines.append('        if not %s(token): continue' % func)
+            elif kind=='filterfalse':
+                lines.append('        if %s(token): continue' % func)
+            else: # pragma: no cover
+                raise ValueError('Unknown kind of step %s' % kind)
+        lines.append('        yield token')
+        namespace={}
+        exec('\n'.join(lines), namespace)
+        _fused[kinds]=namespace['fused']
+    return partial(_fused[kinds], *(func or bool for kind, func in steps))
+
+def _stagekernel(func, tokenskw):
+    """
+    Returns the steps of the kernel equivalent to the (partial) function wrapped by a ``Connector``, or ``None`` if there
+    isn't one
+    """
+    if not (isinstance(func, partial) and tokenskw in func.keywords and func.func in _kernels):
+        return None
+    kwargs=dict((key, value) for key, value in func.keywords.items() if key!=tokenskw)
+    try:
+        return _kernels[func.func](*func.args, **kwargs)
+    except TypeError: # Let the stage raise its own error when it runs
+        return None
+
+def fuse(tokens):
+    """
+    Finds the longest run of adjacent pure per-token stages (``smap``, ``strip``, ``replace``, ``sfilter``, ``matches``,
+    ``split``, ``join``, ``sformat``, ``search``) at the end of a pipeline and fuses them into a single ``Connector`` that processes
+    each token in one loop. This is done automatically when a pipeline is closed by a ``Terminator`` (set
+    ``Terminator.fusion=False`` to turn it off), but can be called directly to get a fused pipeline to iterate over
+
+    >>> from streamutils import *
+    >>> lines = [' Flopsy Mopsy ', ' Cottontail Peter ']
+    >>> pipeline = fuse(lines | strip() | matches('opsy') | split(2) | smap(str.upper))
+    >>> pipeline.__name__
+    'fused'
+    >>> pipeline | write()
+    MOPSY
+    >>> lines | strip() | matches('opsy') | split(2) | smap(str.upper) | first() # Fused ahead of the terminator
+    'MOPSY'
+
+    :param tokens: The pipeline to fuse
+    :return: A fused ``Connector`` if there are at least two stages to fuse, otherwise ``tokens`` unchanged
+    """
+    stages=[]
+    stage=tokens
+    while isinstance(stage, Connector) and stage.it is None and isinstance(stage.func, partial) \
+            and stage.func.func in _kernels and stage.tokenskw in stage.func.keywords:
+        stages.append(stage)
+        stage=stage.func.keywords[stage.tokenskw]
+    if len(stages)<2: # Don't build kernels (e.g. compile patterns) that won't be used
+        return tokens
+    steps=[]
+    for fusable, stage in enumerate(stages):
+        kernel=_stagekernel(stage.func, stage.tokenskw)
+        if kernel is None:
+            break
+        steps[0:0]=kernel
+        stage=stage.func.keywords[stage.tokenskw]
+    else:
+        fusable=len(stages)
+    if fusable<2:
+        return tokens
+    loop=_compilesteps(steps)
+    def fused(tokens): # A real function (not a partial), so that it can be wrapped by update_wrapper on python 2
+        return loop(tokens=tokens)
+    return Connector(fused)(tokens=stage)
+
+_batchterminators = {}
+
+def _batchapply(steps, batchsize, tokens):
+    """Applies kernel steps to each batch in turn, using the builtin ``map`` and ``filter`` over the whole batch"""
+    for batch in tokens:
+        for kind, func in steps:
+            if kind=='map':
+                batch=list(map(func, batch))
+            elif kind=='filter':
+                batch=list(filter(func, batch))
+            else:
+                batch=list(filterfalse(func, batch))
+        if batch:
+            yield batch
+
+def _rebatch(batchsize, tokens):
+    """Groups a stream of tokens back into batches"""
+    it=iter(tokens)
+    while True:
+        batch=list(islice(it, batchsize))
+        if not batch:
+            return
+        yield batch
+
+def _unbatch(tokens):
+    for batch in tokens:
+        for token in batch:
+            yield token
+
+def _batchstage(func, tokenskw, batchsize):
+    """
+    Converts the (partial) function wrapped by a ``Connector`` so that it receives and passes on batches of tokens. Stages
+    with a kernel (see :py:func:`fuse`) run it over each batch (and batch stages that follow one another are combined into
+    one), other stages see the tokens one at a time as usual and their output is grouped back into batches
+
+    :param func: A ``partial`` whose ``tokenskw`` keyword argument is the upstream ``Connector`` that yields batches
+    :param tokenskw: The keyword argument ``func`` receives its tokens on
+    :param batchsize: The size of the batches to pass on
+    :return: a ``partial`` that yields batches of tokens when called
+    """
+    upstream=func.keywords[tokenskw]
+    steps=_stagekernel(func, tokenskw)
+    if steps is None:
+        func.keywords[tokenskw]=Connector(_unbatch)(tokens=upstream)
+        return update_wrapper(partial(_rebatch, batchsize=batchsize, tokens=Connector(func, tokenskw)), func.func)
+    if isinstance(upstream.func, partial) and upstream.func.func is _batchapply and upstream.it is None:
+        steps=upstream.func.args[0]+steps
+        upstream=upstream.func.keywords['tokens']
+    return update_wrapper(partial(_batchapply, steps, batchsize=batchsize, tokens=upstream), func.func)
+
+@connector
+def batched(n=1000, tokens=None):
+    r"""
+    Groups the tokens in the stream into ``list``s of ``n`` tokens, and switches the rest of the pipeline into batched
+    mode. In batched mode, stages that act on one token at a time (``matches``, ``search``, ``split``, ``replace``,
+    ``strip``, ``join``, ``sformat``, ``smap``, ``sfilter``) process a whole batch at a time (so the per-token cost of
+    the interpreter is paid once per batch), and ``count`` counts the batches without unpacking them. Other stages
+    receive the tokens one at a time as usual, with their output grouped back into batches, so a pipeline gives the same
+    result whether or not it is batched. Terminators receive the tokens one at a time, and ``unbatched`` ends batched
+    mode explicitly.
+
+    >>> from streamutils import *
+    >>> lines = ['%d green bottles' % i for i in range(10, 0, -1)]
+    >>> lines | batched(4) | matches('[13579] ') | split(1) | unbatched() | write()
+    9
+    7
+    5
+    3
+    1
+    >>> lines | batched(4) | search('^(1\d*)') | count()
+    2
+    >>> lines | batched(4) | head(3) | smap(str.upper) | last()
+    '8 GREEN BOTTLES'
+    >>> [1, 2, 3] | batched(2) | aslist()
+    [1, 2, 3]
+
+    :param n: The number of tokens in each batch
+    :param tokens: The tokens to batch up
+    """
+    return _rebatch(n, tokens)
+
 @connector
-def run(command, err=False, cwd=None, env=None, tokens=None):
+def unbatched(tokens=None):
+    """
+    Ends batched mode (see ``batched``) by passing on the tokens in each batch one at a time
+
+    >>> ['Happy', 'Sneezy', 'Dopey'] | batched(2) | unbatched() | smap(len) | aslist()
+    [5, 6, 5]
+
+    :param tokens: A stream of batches of tokens
     """
+    return _unbatch(tokens)
+
+_profiling = threading.local() # Holds the Profile that this thread's pipelines are profiled into, if any (see profile)
+_clock = getattr(time, 'perf_counter', time.time)
+_cpuclock = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+
+class _StageProfile(object):
+    """The running totals for one stage of a profiled pipeline (or the same stage of pipelines built the same way)"""
+    def __init__(self, name, key=None, terminator=False):
+        self.name=name
+        self.key=key
+        self.terminator=terminator
+        self.upstream=None
+        self.tokens=0
+        self.wall=self.cpu=0.0
+
+    @contextmanager
+    def timing(self):
+        wall, cpu=_clock(), _cpuclock()
+        try:
+            yield
+        finally:
+            self.wall+=_clock()-wall
+            self.cpu+=_cpuclock()-cpu
+
+class _ProfiledIterator(Iterator):
+    """Wraps the iterator of a ``Connector``, counting the tokens it passes on and timing how long they take to produce"""
+    def __init__(self, it, stage):
+        self.it=it
+        self.stage=stage
+
+    def __next__(self):
+        wall, cpu=_clock(), _cpuclock()
+        try:
+            token=next(self.it)
+        finally:
+            self.stage.wall+=_clock()-wall
+            self.stage.cpu+=_cpuclock()-cpu
+        self.stage.tokens+=1
+        return token
+    next=__next__ # python 2
+
+    def close(self):
+        if hasattr(self.it, 'close'):
+            with self.stage.timing():
+                self.it.close()
+
+class Profile(object):
+    """
+    The statistics collected for each stage of the pipelines run inside a ``with profile()`` block. Stages of pipelines
+    that are built in the same way (e.g. in a loop) are added together
+    """
+    def __init__(self):
+        self.stages=[]      # In pipeline order
+        self.bykey={}
+        self.downstream={}  # id of a Connector that hasn't been iterated yet -> (the Connector, the stage reading from it)
+        self.lock=threading.Lock()
+
+    def _stage(self, name, upstream, downstream=None, terminator=False):
+        key=[name]
+        tokens=upstream
+        while isinstance(tokens, Connector): # Key the stage by the shape of the pipeline it is in
+            key.append(tokens.__name__)
+            tokens=tokens.func.keywords.get(tokens.tokenskw) if isinstance(tokens.func, partial) else None
+        key=(tuple(key), downstream.key if downstream else None)
+        with self.lock:
+            stage=self.bykey.setdefault(key, _StageProfile(name, key, terminator))
+            if stage not in self.stages:
+                self.stages.insert(self.stages.index(downstream) if downstream else len(self.stages), stage)
+            if downstream:
+                downstream.upstream=stage
+            if isinstance(upstream, Connector): # Keep a reference to the Connector so that its id isn't reused
+                self.downstream[id(upstream)]=(upstream, stage)
+        return stage
+
+    def enter(self, connector):
+        """Returns the running totals for a ``Connector`` that is about to be iterated over"""
+        with self.lock:
+            downstream=self.downstream.pop(id(connector), (None, None))[1]
+        upstream=connector.func.keywords.get(connector.tokenskw) if isinstance(connector.func, partial) else None
+        return self._stage(connector.__name__, upstream, downstream)
+
+    def timing(self, terminator, tokens):
+        """Returns a context manager that times a ``Terminator`` that is being called with ``tokens``"""
+        return self._stage(terminator.__name__, tokens, terminator=True).timing()
+
+    def stats(self):
+        """
+        Returns a ``list`` with a ``dict`` for each stage (in pipeline order) with the stage's ``name``, the number of
+        tokens that went ``in`` and ``out`` of it (``None`` if unknown), the ``wall`` and ``cpu`` time in seconds spent
+        getting tokens out of it, how much of that was spent ``waiting`` for the stage before it, the time it spent itself
+        (``self``) and that time as a ``share`` of the time spent by all the stages
+        """
+        stats=[]
+        for stage in self.stages:
+            upstream=stage.upstream or _StageProfile(None)
+            stats.append(OrderedDict([('name', stage.name), ('in', upstream.tokens if stage.upstream else None),
+                                      ('out', None if stage.terminator else stage.tokens), ('wall', stage.wall),
+                                      ('cpu', max(0.0, stage.cpu-upstream.cpu)), ('waiting', upstream.wall),
+                                      ('self', max(0.0, stage.wall-upstream.wall))]))
+        total=sum(stat['self'] for stat in stats) or 1
+        for stat in stats:
+            stat['share']=stat['self']/total
+        return stats
+
+    def report(self):
+        """Returns the statistics for each stage (see ``stats``) as a table, followed by the stage that took longest"""
+        stats=self.stats()
+        lines=['%-12s %10s %10s %9s %9s %9s %9s %6s' % ('stage', 'in', 'out', 'wall', 'self', 'cpu', 'waiting', 'share')]
+        for stat in stats:
+            lines.append('%-12s %10s %10s %9.4f %9.4f %9.4f %9.4f %5.1f%%' % (stat['name'],
+                         '-' if stat['in'] is None else stat['in'], '-' if stat['out'] is None else stat['out'],
+                         stat['wall'], stat['self'], stat['cpu'], stat['waiting'], 100*stat['share']))
+        if stats:
+            slowest=max(stats, key=lambda stat: stat['self'])
+            lines.append('%s spends %.0f%% of the time' % (slowest['name'], 100*slowest['share']))
+        return '\n'.join(lines)
+
+@contextmanager
+def profile():
+    r"""
+    Profiles the pipelines run inside a ``with`` block, recording for each stage how many tokens go in and out, and how
+    long it takes, split into the time it spends itself and the time it spends waiting for the stage before it. Adjacent
+    stages aren't fused while profiling (see ``fuse``), so that they can be timed separately. ``report`` shows which
+    stage is the bottleneck, and ``stats`` returns the numbers. Only the pipelines run by the thread that entered the block
+    are profiled (not e.g. those run in the worker threads of :py:mod:`streamutils.aio`), and a nested ``profile`` block
+    records its pipelines instead of the block around it
+
+    >>> from streamutils import *
+    >>> lines=['%d green bottles' % i for i in range(10, 0, -1)]
+    >>> with profile() as p:
+    ...     lines | matches('[13579] ') | split(1) | smap(int) | ssum()
+    25
+    >>> print(p.report())
+    stage                in        out      wall      self       cpu   waiting  share
+    matches               -          5    ...
+    split                 5          5    ...
+    smap                  5          5    ...
+    ssum                  5          -    ...
+    ... spends ...% of the time
+    >>> [(stat['name'], stat['in'], stat['out']) for stat in p.stats()][-1]
+    ('ssum', 5, None)
+    """
+    previous=getattr(_profiling, 'profile', None)
+    _profiling.profile=Profile()
+    try:
+        yield _profiling.profile
+    finally:
+        _profiling.profile=previous
+
+def _human(n, unit='B'):
+    for prefix in ['', 'k', 'M', 'G', 'T']:
+        if abs(n)<1000 or prefix=='T':
+            return ('%.0f%s%s' if not prefix else '%.1f%s%s') % (n, prefix, unit)
+        n/=1000
+
+class _Progress(object):
+    """
+    Counts the tokens (and their size) that pass through a stage and (if reading files) how far through the files it has
+    read, and reports them every ``every`` seconds, either to standard error or by calling ``progress`` if it is callable
+    """
+    def __init__(self, name, progress=True, every=1.0, total=None, files=None, sizes=True):
+        self.name=name
+        self.callback=progress if callable(progress) else self.write
+        self.every=every
+        self.total=total
+        self.sizes=sizes
+        self.filesize=None
+        self.filesizes={}
+        if isinstance(files, (list, tuple)):
+            filesizes=[_filesize(fname) for fname in files]
+            self.filesize=sum(filesizes) if None not in filesizes else None
+            self.filesizes=dict(zip(files, filesizes))
+        self.file=None
+        self.done=0
+        self.tokens=self.size=0
+        self.start=_clock()
+        self.due=self.start+every
+
+    def count(self, token):
+        self.tokens+=1
+        if self.sizes and (isinstance(token, string_types) or isinstance(token, bytes)):
+            self.size+=len(token)
+        if _clock()>=self.due:
+            self.report()
+        return token
+
+    def filedone(self, fname=None):
+        position=_fileposition(self.file)
+        if position is None: # Can't tell how far through the file it is (e.g. it has no file descriptor), but it's all read
+            position=self.filesizes.get(fname)
+        self.done+=position or 0
+        self.file=None
+
+    def stats(self, final=False):
+        elapsed=max(_clock()-self.start, 1e-9)
+        position=_fileposition(self.file) if self.file is not None else None
+        read=None if position is None and not self.done else self.done+(position or 0)
+        fraction=eta=None
+        if self.filesize and read is not None:
+            fraction=min(1.0, read/self.filesize)
+        elif self.total:
+            fraction=min(1.0, self.tokens/self.total)
+        if fraction:
+            eta=0 if final else elapsed*(1-fraction)/fraction
+        return OrderedDict([('name', self.name), ('tokens', self.tokens), ('elapsed', elapsed),
+                            ('rate', self.tokens/elapsed), ('size', self.size if self.sizes else None),
+                            ('sizerate', self.size/elapsed if self.sizes else None), ('read', read),
+                            ('filesize', self.filesize), ('readrate', None if read is None else read/elapsed),
+                            ('fraction', fraction), ('eta', eta), ('final', final)])
+
+    def report(self, final=False):
+        self.due=_clock()+self.every
+        self.callback(self.stats(final))
+
+    def finish(self):
+        self.report(final=True)
+
+    @staticmethod
+    def write(stats):
+        parts=['%s: %d tokens (%s)' % (stats['name'], stats['tokens'], _human(stats['rate'], '/s'))]
+        if stats['size'] is not None:
+            parts.append('%s (%s)' % (_human(stats['size']), _human(stats['sizerate'], 'B/s')))
+        if stats['read'] is not None:
+            parts.append('%s%s read (%s)' % (_human(stats['read']),
+                         ' of %s' % _human(stats['filesize']) if stats['filesize'] else '', _human(stats['readrate'], 'B/s')))
+        if stats['fraction'] is not None:
+            parts.append('%.0f%% done' % (100*stats['fraction']))
+        if stats['eta'] is not None and not stats['final']:
+            parts.append('ETA %d:%02d:%02d' % (stats['eta']//3600, stats['eta']%3600//60, stats['eta']%60))
+        sys.stderr.write(', '.join(parts)+('\n' if stats['final'] else '\r'))
+        sys.stderr.flush()
+
+def _metered(tokens, meter):
+    try:
+        for token in tokens:
+            yield meter.count(token)
+    finally:
+        meter.finish()
+
+@connector
+def progress(every=1.0, callback=None, total=None, name='progress', tokens=None):
+    """
+    Passes tokens on unchanged, reporting how many have passed (and the rate at which they are passing) every ``every``
+    seconds and once all of them have passed. Unless a ``callback`` is given, the progress is written to standard error.
+    ``read``, ``gzread``, ``bzread`` and ``find`` can also report their progress (with ``progress=True`` or a callback),
+    in which case the report includes how far through the files they are, and so how long is left
+
+    >>> from streamutils import *
+    >>> def report(stats):
+    ...     print('%s: %d tokens, %d characters, %d%% done' % (stats['name'], stats['tokens'], stats['size'], 100*stats['fraction']))
+    >>> ['Happy', 'Sneezy', 'Dopey'] | progress(callback=report, total=3) | aslist()
+    progress: 3 tokens, 16 characters, 100% done
+    ['Happy', 'Sneezy', 'Dopey']
+    >>> stats = []
+    >>> bzread('examples/NASA_access_log_July95.log.bz2', progress=stats.append) | count()
+    10000
+    >>> stats[-1]['tokens'], stats[-1]['read'] == stats[-1]['filesize'], stats[-1]['fraction']
+    (10000, True, 1.0)
+
+    Each report is a ``dict`` with the ``name`` of the stage, the number of ``tokens`` passed on, the ``elapsed`` time in
+    seconds, the ``rate`` in tokens per second, the total ``size`` of the tokens (if they are strings) and the ``sizerate``
+    per second. For files, ``read`` is the number of bytes read from the files (before decompression), ``filesize`` is
+    their total size and ``readrate`` the bytes read per second. ``fraction`` is the fraction of the way through the files
+    (or through ``total`` tokens), ``eta`` is the estimated number of seconds left, and ``final`` is ``True`` for the
+    report made at the end of the stream
+
+    :param every: How often to report, in seconds
+    :param callback: Function to call with each report (by default, the report is written to standard error)
+    :param total: The number of tokens expected, if known, so that the time left can be estimated
+    :param name: The name to use in the report
+    :param tokens: The tokens to pass on
+    """
+    return _metered(tokens, _Progress(name, callback or True, every, total))
+
+def _feed(stdin, tokens, errors, stop):
+    """
+    Writes tokens to the standard input of a process and then closes it (run in a thread by ``run``). Only this thread
+    touches ``tokens``, so it stops at the next token once ``stop`` is set and closes ``tokens`` itself
+    """
+    import errno
+    try:
+        for token in tokens:
+            if stop.is_set():
+                break
+            stdin.write(token)
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EPIPE, errno.EINVAL): # Otherwise the process has just stopped reading
+            errors.append(sys.exc_info())
+    except Exception:
+        errors.append(sys.exc_info())
+    finally:
+        try:
+            stdin.close()
+        except (IOError, OSError):
+            pass
+        if hasattr(tokens, 'close'):
+            tokens.close()
+
+@connector
+def run(command, err=False, cwd=None, env=None, binary=False, check=False, tokens=None):
+    r"""
     Runs a command. If command is a string then it will be split with :py:func:`shlex.split` so that it works as
-    expected on windows. Current implementation runs in the same process so gathers the full output of the command 
-    before passing output to subsequent functions.
+    expected on windows. The output of the command is passed on line by line as the command produces it, and tokens
+    are written to its standard input from a background thread, so a command can sit in the middle of a pipeline without
+    the whole stream needing to fit in memory. If the stream is closed before the command finishes, the command is
+    terminated, and the thread writing the tokens stops (and closes them) when the next token arrives. If the command
+    exits by itself, ``run`` waits for that thread to stop (like a shell pipeline, that's when the next token arrives),
+    so that any error from the tokens is raised. Either way, the command is waited for so that it doesn't linger as a
+    zombie.
 
     >>> from streamutils import * #Suggestions for better commands to use as examples welcome!
     >>> rev=run('git log --reverse') | search('commit (\w+)', group=1) | first()
     >>> rev == run('git log') | search('commit (\w+)', group=1) | last()
     True
+    >>> import sys, subprocess
+    >>> upper=[sys.executable, '-c', 'import sys; sys.stdout.write(sys.stdin.read().upper())']
+    >>> ['Happy\n', 'Grumpy\n'] | run(upper) | strip() | write()
+    HAPPY
+    GRUMPY
+    >>> try:
+    ...     run([sys.executable, '-c', 'import sys; sys.exit(3)'], check=True) | count()
+    ... except subprocess.CalledProcessError as e:
+    ...     print(e.returncode)
+    3
+    >>> def waiting(): # Like follow, waiting for a line that doesn't come
+    ...     yield 'first\n'
+    ...     time.sleep(30)
+    >>> start=time.time()
+    >>> Connector(waiting) | run([sys.executable, '-c', 'while True: print("y")']) | head(1) | strip() | write()
+    y
+    >>> time.time()-start < 10 # Closing the stream early doesn't wait for the tokens
+    True
+    >>> def failing():
+    ...     yield 'first\n'
+    ...     time.sleep(1.5)
+    ...     raise ValueError('Bad token')
+    >>> try:
+    ...     failing() | run([sys.executable, '-c', 'print("y")']) | count()
+    ... except ValueError as e:
+    ...     print(e)
+    Bad token
 
     :param command: Command to run as a string or list
     :param err: Redirect standard error to standard out (default False)
     :param cwd: Current working directory for command
     :param env: Environment to pass into command
-    :param encoding: Encoding to use to parse the output. Defaults to the default locale, or utf-8 if there isn't one
+    :param binary: If True, pass on the output as ``bytes`` without decoding it (tokens should then be ``bytes`` too)
+    :param check: If True, raise a :py:class:`subprocess.CalledProcessError` at the end of the stream if the command
+        exits with a non-zero exit status
     :param tokens: Lines to pass into the command as standard in
     """
-    stdin=None if tokens is None else StringIO("".join(list(tokens)))
+    import subprocess, shlex
     if isinstance(command, string_types):
         command=shlex.split(command)
-    #@Todo: Change so that it uses communicate on a popen object so that the entire output doesn't need to fit in memory
-    if not err:
-        output=subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stdin=stdin, env=env, universal_newlines=True).stdout
-    else:
-        output=subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=stdin, env=env, universal_newlines=True).stdout
-    return output
+    proc=subprocess.Popen(command, cwd=cwd, env=env, stdin=None if tokens is None else subprocess.PIPE,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT if err else None,
+                          universal_newlines=not binary)
+    errors, stop=[], threading.Event()
+    if tokens is not None:
+        writer=threading.Thread(target=_feed, args=(proc.stdin, tokens, errors, stop))
+        writer.daemon=True
+        writer.start()
+    finished=False
+    try:
+        for line in proc.stdout:
+            yield line
+        finished=True
+    finally:
+        stop.set()
+        proc.stdout.close()
+        if not finished and proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+        if tokens is not None and finished:
+            # The process has exited and stop is set, so the writer stops at the next token - wait for it so that an
+            # error from the tokens is always raised
+            writer.join()
+    if errors:
+        reraise(*errors[0])
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+_closestokens.add(run.func)
 
 @terminator
 def first(default=None, tokens=None):
@@ -553,7 +1499,7 @@ def nth(n, default=None, tokens=None):
 def ssorted(cmp=None, key=None, reverse=False, tokens=None):
     """
     Sorts the output of the stream (see documentation for :py:func:`sorted`). Warning: ``cmp`` was removed from ``sorted``
-    in python 3
+    in python 3. To sort more tokens than will fit in memory, use ``extsort``
 
     >>> from streamutils import *
     >>> for line in (find('*.py') | replace(os.sep, '/') | ssorted()):
@@ -568,6 +1514,106 @@ def ssorted(cmp=None, key=None, reverse=False, tokens=None):
     else:
         return sorted(tokens, cmp=cmp, key=key, reverse=reverse)
 
+class _Reversed(object):
+    """Wraps a sort key so that it sorts backwards"""
+    __slots__=['key']
+    def __init__(self, key):
+        self.key=key
+    def __lt__(self, other):
+        return other.key<self.key
+    def __eq__(self, other):
+        return self.key==other.key
+
+def _mergesorted(runs, key=None, reverse=False):
+    """Merges iterables that are already sorted into one sorted iterator, keeping items that compare equal in order"""
+    import heapq
+    if sys.version_info>=(3, 5): # pragma: no cover
+        return heapq.merge(*runs, key=key, reverse=reverse)
+    key=key or (lambda item: item) # pragma: no cover
+    decorate=(lambda item: _Reversed(key(item))) if reverse else key # pragma: no cover
+    runs=[((decorate(item), i, j, item) for j, item in enumerate(run)) for i, run in enumerate(runs)] # pragma: no cover
+    return (item for k, i, j, item in heapq.merge(*runs)) # pragma: no cover
+
+def _spillrun(items, chunksize=1024):
+    """Writes ``items`` to a temporary file (``chunksize`` at a time, which is much quicker to read back than one at a time)"""
+    import tempfile
+    from six.moves import cPickle as pickle
+    f=tempfile.TemporaryFile()
+    items=iter(items)
+    while True:
+        chunk=list(islice(items, chunksize))
+        if not chunk:
+            break
+        pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def _readrun(f):
+    """Yields the items written to a temporary file by ``_spillrun``, closing it once they have all been read"""
+    with closing(f):
+        for chunk in _unspill(f):
+            for item in chunk:
+                yield item
+
+_SORTFANIN = 128 # The most sorted runs that extsort will merge (and so hold open) at once
+
+@connector
+def extsort(key=None, reverse=False, buffersize=100000, tokens=None):
+    """
+    Sorts the stream without holding all of it in memory (an external merge sort), for when there's too much to pass to
+    ``ssorted``. Tokens are read ``buffersize`` at a time, and each batch is sorted and written out to a temporary file.
+    Then the sorted batches (runs) are merged (at most ``128`` at a time, so that the merge doesn't run out of file
+    handles), and the sorted tokens are passed on as they are merged. Like :py:func:`sorted`, the sort is stable. Tokens
+    must be picklable if there are more than ``buffersize`` of them.
+
+    >>> from streamutils import *
+    >>> import random
+    >>> tokens=[random.randint(0, 1000) for i in range(10000)]
+    >>> tokens | extsort(buffersize=100) | aslist() == sorted(tokens)
+    True
+    >>> ['Happy', 'Doc', 'Sneezy', 'Dopey', 'Bashful'] | extsort(key=len, reverse=True, buffersize=2) | aslist()
+    ['Bashful', 'Sneezy', 'Happy', 'Dopey', 'Doc']
+    >>> try:
+    ...     [2, 1] | extsort(buffersize=0) | aslist()
+    ... except ValueError as e:
+    ...     print(e)
+    buffersize must be at least 1
+
+    :param key: function of one argument used to get the value to sort each token by
+    :param reverse: If True, sort in descending order
+    :param buffersize: The number of tokens to sort in memory at once
+    :param tokens: The items in the pipeline
+    """
+    if not buffersize or buffersize<1:
+        raise ValueError('buffersize must be at least 1')
+    tokens=iter(tokens)
+    levels=[[]] # levels[n] holds runs made by merging _SORTFANIN runs from levels[n-1] (so older runs are further up)
+    while True:
+        run=list(islice(tokens, buffersize))
+        run.sort(key=key, reverse=reverse)
+        if len(levels)==1 and not levels[0] and len(run)<buffersize: # Everything fits in memory
+            for token in run:
+                yield token
+            return
+        if run:
+            levels[0].append(_spillrun(run))
+        if len(run)<buffersize:
+            break
+        for n, level in enumerate(levels):
+            if len(level)<_SORTFANIN:
+                break
+            if n+1==len(levels):
+                levels.append([])
+            levels[n+1].append(_spillrun(_mergesorted([_readrun(f) for f in level], key, reverse)))
+            del level[:]
+    runs=[f for level in reversed(levels) for f in level]
+    try:
+        for token in _mergesorted([_readrun(f) for f in runs], key, reverse):
+            yield token
+    finally:
+        for f in runs:
+            f.close()
+
 @terminator
 def nsmallest(n, key=None, tokens=None):
     """
@@ -577,7 +1623,7 @@ def nsmallest(n, key=None, tokens=None):
     >>> head(10, tokens=range(1,10)) | nsmallest(4)
     [1, 2, 3, 4]
     """
-    return heapq.nsmallest(n, tokens, key) if key else heapq.nsmallest(n, tokens)
+    return NSmallest(n, key).update(tokens).result()
 
 
 @terminator
@@ -589,7 +1635,358 @@ def nlargest(n, key=None, tokens=None):
     >>> head(10, tokens=range(1,10)) | nlargest(4)
     [9, 8, 7, 6]
     """
-    return heapq.nlargest(n, tokens, key) if key else heapq.nlargest(n, tokens)
+    return NLargest(n, key).update(tokens).result()
+
+def _keygetter(keys):
+    """Returns a function that gets the value of ``keys`` (a single key, or a tuple of the values of several) from a token"""
+    if isinstance(keys, string_types):
+        return itemgetter(keys)
+    keys=list(_wrapInIterable(keys))
+    return itemgetter(*keys) if len(keys)>1 else lambda data: (data[keys[0]],)
+
+class Accumulator(object):
+    """
+    Base class for the state of an aggregation (e.g. a running total) which can be built up a token at a time with
+    ``add`` (or many at a time with ``update``), combined with the state from other tokens (e.g. from another file,
+    process or machine) with ``merge``, and turned into a final value with ``result``. Accumulators can be pickled
+    (as long as any ``key`` functions can be), so can be passed between processes. End a pipeline with
+    ``accumulate(accumulator)`` to get the accumulator rather than its result, or pass one to ``window`` to keep
+    constant memory per window.
+    """
+    def add(self, token):
+        """Adds a token, returning the accumulator"""
+        return self.update((token,))
+
+    def update(self, tokens):
+        """Adds all the tokens in an iterable, returning the accumulator"""
+        raise NotImplementedError #pragma: no cover
+
+    def merge(self, other):
+        """Adds the state from another accumulator of the same type, returning this one"""
+        raise NotImplementedError #pragma: no cover
+
+    def result(self):
+        """Returns the value of the aggregation"""
+        raise NotImplementedError #pragma: no cover
+
+    def __repr__(self):
+        return '<%s: %r>' % (type(self).__name__, self.result())
+
+class Count(Accumulator):
+    """Accumulates the number of tokens (see ``count``)"""
+    def __init__(self):
+        self.count=0
+
+    def update(self, tokens):
+        self.count+=sum(1 for token in tokens)
+        return self
+
+    def merge(self, other):
+        self.count+=other.count
+        return self
+
+    def result(self):
+        return self.count
+
+class Sum(Accumulator):
+    """Accumulates the sum of the tokens (see ``ssum``). ``start`` is only added once, however many are merged"""
+    def __init__(self, start=0):
+        self.start=start
+        self.total=None
+        self.empty=True # Not just total is None, as None might be summed (and sentinels don't survive pickling)
+
+    def update(self, tokens):
+        tokens=iter(tokens)
+        if self.empty:
+            for token in tokens:
+                self.total, self.empty=token, False
+                break
+            else:
+                return self
+        self.total=sum(tokens, self.total)
+        return self
+
+    def merge(self, other):
+        return self if other.empty else self.update((other.total,))
+
+    def result(self):
+        return self.start if self.empty else self.start+self.total
+
+class Max(Accumulator):
+    """Accumulates the largest token (see ``smax``)"""
+    choose=staticmethod(max)
+
+    def __init__(self, key=None):
+        self.key=key
+        self.best=None
+        self.empty=True
+
+    def update(self, tokens):
+        tokens=iter(tokens)
+        if self.empty:
+            for token in tokens:
+                self.best, self.empty=token, False
+                break
+            else:
+                return self
+        self.best=self.choose(ichain((self.best,), tokens), key=self.key) if self.key else self.choose(ichain((self.best,), tokens))
+        return self
+
+    def merge(self, other):
+        return self if other.empty else self.update((other.best,))
+
+    def result(self):
+        if self.empty:
+            raise ValueError('%s of an empty stream' % type(self).__name__)
+        return self.best
+
+    def __repr__(self):
+        return '<%s: %r>' % (type(self).__name__, self.best)
+
+class Min(Max):
+    """Accumulates the smallest token (see ``smin``)"""
+    choose=staticmethod(min)
+
+class Bag(Accumulator):
+    """Accumulates the number of times each token appears (see ``bag``)"""
+    def __init__(self):
+        self.counts=Counter()
+
+    def update(self, tokens):
+        self.counts.update(tokens)
+        return self
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        return self
+
+    def result(self):
+        return Counter(self.counts)
+
+class CountBy(Bag):
+    """Accumulates the number of times each value (or tuple of values) of ``keys`` appears (see ``countby``)"""
+    def __init__(self, keys):
+        Bag.__init__(self)
+        self.keys=keys
+
+    def update(self, tokens):
+        self.counts.update(map(_keygetter(self.keys), tokens))
+        return self
+
+class NLargest(Accumulator):
+    """Accumulates the ``n`` largest tokens (see ``nlargest``)"""
+    select='nlargest' # The heapq function to select the items with
+
+    def __init__(self, n, key=None):
+        self.n=n
+        self.key=key
+        self.items=[]
+
+    def add(self, token):
+        self.items.append(token)
+        if len(self.items)>2*self.n+16: # Prune the list now and then rather than on every token
+            self.items=self.result()
+        return self
+
+    def update(self, tokens):
+        self.items=self.result(ichain(self.items, tokens))
+        return self
+
+    def merge(self, other):
+        return self.update(other.items)
+
+    def result(self, items=None):
+        import heapq
+        items=self.items if items is None else items
+        select=getattr(heapq, self.select)
+        return select(self.n, items, self.key) if self.key else select(self.n, items)
+
+class NSmallest(NLargest):
+    """Accumulates the ``n`` smallest tokens (see ``nsmallest``)"""
+    select='nsmallest'
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError: # pragma: no cover
+        print('numpy required for columnar aggregation - try installing numpy')
+        raise
+    return numpy
+
+def _sumcolumn(numpy, codes, column, totals):
+    """
+    Returns the totals for each code after adding on the values in column, or ``None`` if numpy can't get exactly the
+    same answer as adding them up one at a time in python would
+    """
+    if not len(column):
+        return totals
+    types=set(map(type, column))
+    if len(types)!=1 or not types<=set(integer_types+(bool, float)): # e.g. a mixture of ints and floats, or numpy types
+        return None
+    values=numpy.asarray(column)
+    if values.dtype.kind in 'biu' and all(isinstance(total, integer_types) for total in totals):
+        if int(numpy.abs(values).max())*len(values)>=2**63: # Could overflow an int64
+            return None
+        sums=numpy.zeros(len(totals), numpy.int64)
+        numpy.add.at(sums, codes, values)
+        return [total+s for total, s in zip(totals, sums.tolist())]
+    if values.dtype.kind=='f' and numpy.abs(values).max()<2**53 and all(abs(total)<2**53 for total in totals):
+        # bincount adds up the weights for each bin in order, so starting from the totals so far, it adds up the floats
+        # in the same order as python would
+        weights=numpy.concatenate([numpy.asarray(totals, dtype=numpy.float64), values.astype(numpy.float64)])
+        return numpy.bincount(numpy.concatenate([numpy.arange(len(totals)), codes]), weights, len(totals)).tolist()
+    return None
+
+class SumBy(Accumulator):
+    """
+    Accumulates the sum of the values for each key, either from ``(key, value)`` tokens or, if ``keys`` and ``values``
+    are set, from ``dict`` tokens (see ``sumby``). If ``columnar`` is set, tokens are read ``chunksize`` at a time and
+    their values added up with numpy
+    """
+    def __init__(self, keys=None, values=None, columnar=False, chunksize=100000):
+        self.keys=keys
+        self.values=_wrapInIterable(values)
+        self.sums={}
+        self.columnar=columnar
+        self.chunksize=chunksize
+
+    def updatecolumns(self, tokens, counts=None):
+        """Adds tokens to the totals a chunk at a time using numpy (and counts how many there are of each key to ``counts``)"""
+        numpy=_numpy()
+        sums, keys, values=self.sums, self.keys, self.values
+        keyed=keys and values
+        aggkey=_keygetter(keys) if keyed else None
+        index=dict((key, i) for i, key in enumerate(sums)) # The code for each key
+        keylist=list(sums)
+        tokens=iter(tokens)
+        while True:
+            chunk=list(islice(tokens, self.chunksize))
+            if not chunk:
+                return self
+            if keyed:
+                keycolumn=list(map(aggkey, chunk))
+                columns=[(value, list(map(itemgetter(value), chunk))) for value in values]
+            else:
+                keycolumn, column=list(map(itemgetter(0), chunk)), list(map(itemgetter(1), chunk))
+                columns=[(None, column)]
+            for key in OrderedDict.fromkeys(keycolumn): # New keys, in the order they first appear
+                if key not in index:
+                    index[key]=len(keylist)
+                    keylist.append(key)
+                    sums[key]={} if keyed else 0
+            codes=numpy.fromiter(map(index.__getitem__, keycolumn), numpy.intp, len(keycolumn))
+            found=numpy.bincount(codes, minlength=len(keylist)).tolist()
+            for value, column in columns:
+                totals=[sums[key].get(value, 0) for key in keylist] if keyed else [sums[key] for key in keylist]
+                totals=_sumcolumn(numpy, codes, column, totals)
+                if totals is None: # Add them up in python instead
+                    for key, v in zip(keycolumn, column):
+                        if keyed:
+                            sums[key][value]=sums[key].get(value, 0)+v
+                        else:
+                            sums[key]+=v
+                    continue
+                for key, total, n in zip(keylist, totals, found):
+                    if not n:
+                        continue
+                    if keyed:
+                        sums[key][value]=total
+                    else:
+                        sums[key]=total
+            if counts is not None:
+                for key, n in zip(keylist, found):
+                    if n:
+                        counts[key]=counts.get(key, 0)+n
+
+    def update(self, tokens):
+        if self.columnar:
+            return self.updatecolumns(tokens)
+        sums, keys, values=self.sums, self.keys, self.values
+        if keys and values:
+            aggkey=_keygetter(keys)
+            for data in tokens:
+                totals=sums.setdefault(aggkey(data), {})
+                for value in values:
+                    totals[value]=totals.get(value, 0)+data[value]
+        else:
+            for (key, value) in tokens:
+                sums[key]=sums.get(key, 0)+value
+        return self
+
+    def merge(self, other):
+        sums=self.sums
+        if self.keys and self.values:
+            for key, others in other.sums.items():
+                totals=sums.setdefault(key, {})
+                for value, total in others.items():
+                    totals[value]=totals.get(value, 0)+total
+        else:
+            for key, total in other.sums.items():
+                sums[key]=sums.get(key, 0)+total
+        return self
+
+    def result(self):
+        return dict((key, dict(totals)) for key, totals in self.sums.items()) if self.keys and self.values else dict(self.sums)
+
+class MeanBy(SumBy):
+    """
+    Accumulates the mean of the values for each key, either from ``(key, value)`` tokens or, if ``keys`` and ``values``
+    are set, from ``dict`` tokens (see ``meanby``). If ``columnar`` is set, tokens are read ``chunksize`` at a time and
+    their values added up with numpy
+    """
+    def __init__(self, keys=None, values=None, columnar=False, chunksize=100000):
+        SumBy.__init__(self, keys, values, columnar, chunksize)
+        self.counts={}
+
+    def update(self, tokens):
+        if self.columnar:
+            return self.updatecolumns(tokens, self.counts)
+        sums, counts, keys, values=self.sums, self.counts, self.keys, self.values
+        if keys and values:
+            aggkey=_keygetter(keys)
+            for data in tokens:
+                key=aggkey(data)
+                counts[key]=counts.get(key, 0)+1
+                totals=sums.setdefault(key, {})
+                for value in values:
+                    totals[value]=totals.get(value, 0)+data[value]
+        else:
+            for (key, value) in tokens:
+                counts[key]=counts.get(key, 0)+1
+                sums[key]=sums.get(key, 0)+value
+        return self
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key]=self.counts.get(key, 0)+count
+        return SumBy.merge(self, other)
+
+    def result(self):
+        counts=self.counts
+        if self.keys and self.values:
+            return dict((key, dict((value, total/counts[key]) for value, total in totals.items()))
+                        for key, totals in self.sums.items())
+        return dict((key, total/counts[key]) for key, total in self.sums.items())
+
+@terminator
+def accumulate(accumulator, tokens=None):
+    """
+    Adds the tokens in the stream to an ``Accumulator`` and returns it, so that it can be combined with the results from
+    other streams with ``merge`` before taking the ``result``
+
+    >>> from streamutils import *
+    >>> parts=[[('A', 2), ('B', 6), ('A', 3)], [('C', 20), ('A', 4)]]
+    >>> states=[part | accumulate(MeanBy()) for part in parts]
+    >>> states[0].merge(states[1]).result() == {'A': 3, 'B': 6, 'C': 20}
+    True
+    >>> [3, 1, 2] | accumulate(NLargest(2))
+    <NLargest: [3, 2]>
+
+    :param accumulator: The ``Accumulator`` to add the tokens to (e.g. ``Count()``, ``SumBy()``, ``MeanBy(keys, values)``)
+    :param tokens: The items in the pipeline
+    :return: the accumulator
+    """
+    return accumulator.update(tokens)
 
 @terminator
 def smax(key=None, tokens=None):
@@ -605,7 +2002,7 @@ def smax(key=None, tokens=None):
     :param tokens: a list of things
     :return: The largest item in the stream (as defined by python :py:func:`max`)
     """
-    return max(tokens, key=key) if key else max(tokens)
+    return Max(key).update(tokens).result()
 
 @terminator
 def smin(key=None, tokens=None):
@@ -621,7 +2018,7 @@ def smin(key=None, tokens=None):
     :param tokens: a list of things
     :return: The largest item in the stream (as defined by python :py:func:`min`)
     """
-    return min(tokens, key=key) if key else min(tokens)
+    return Min(key).update(tokens).result()
 
 @terminator
 def count(tokens=None):
@@ -636,7 +2033,12 @@ def count(tokens=None):
     :param tokens: Things to count
     :return: number of items in the stream as an ``int``
     """
-    return sum(1 for line in tokens)
+    return Count().update(tokens).result()
+
+def _countbatches(tokens=None):
+    return sum(len(batch) for batch in tokens)
+
+_batchterminators[count.func]=_countbatches
 
 @terminator
 def ssum(start=0, tokens=None):
@@ -650,10 +2052,10 @@ def ssum(start=0, tokens=None):
     :param start: Initial value to start the sum, returned if the stream is empty
     :return: sum of all the values in the stream
     """
-    return sum(tokens, start)
+    return Sum(start).update(tokens).result()
 
 @terminator
-def sumby(keys=None, values=None, tokens=None):
+def sumby(keys=None, values=None, columnar=False, chunksize=100000, tokens=None):
     """
     If keys and values are not set, given a series of key, value items, returns a ``dict`` of summed values, grouped by key
     
@@ -674,21 +2076,21 @@ def sumby(keys=None, values=None, tokens=None):
     >>> sums == {'North': {'Revenue': 7, 'Cost': 10}, 'West': {'Revenue': 6, 'Cost': 3}}
     True
 
+    If ``columnar`` is set, the tokens are read ``chunksize`` at a time, the keys in each chunk are numbered and the values
+    added up for each number with numpy (which must be installed), which is quicker if there are a lot of tokens with
+    numeric values but not many different keys. The result is exactly the same (if numpy can't add up a chunk of values
+    exactly as python would, e.g. because they're too large or not numbers, they're added up in python instead)
+
+    :param keys: ``dict`` key or keys for the values to aggregate on
+    :param values: ``dict`` key or keys for the values to be summed
+    :param columnar: If True, use numpy to add up the values in chunks
+    :param chunksize: The number of tokens to add up at once if ``columnar`` is set
     :return: dict mapping each key to the sum of all the values corresponding to that key
     """
-    result={}
-    if keys and values:
-        for data in tokens:
-            aggkey= data[keys] if isinstance(keys, string_types) else tuple(data[key] for key in _wrapInIterable(keys))
-            for value in _wrapInIterable(values):
-                result.setdefault(aggkey, {})[value]=result.get(aggkey, {}).get(value, 0)+data[value]
-    else:
-        for (key, value) in tokens:
-            result[key]=result.get(key, 0)+value
-    return result
+    return SumBy(keys, values, columnar, chunksize).update(tokens).result()
 
 @terminator
-def meanby(keys=None, values=None, tokens=None):
+def meanby(keys=None, values=None, columnar=False, chunksize=100000, tokens=None):
     """
     If key is not set, given a series of key, value items, returns a dict of means, grouped by key
     If keys is set, given a series of ``dict``s, returns the mean of the values grouped by
@@ -703,26 +2105,36 @@ def meanby(keys=None, values=None, tokens=None):
     >>> means = head(tokens=[{'key': 1, 'value': 2}, {'key': 1, 'value': 4}, {'key': 2, 'value': 5}]) | meanby('key', 'value')
     >>> means == {1: {'value': 3.0}, 2: {'value': 5.0}}
     True
+    >>> means = [{'key': 1, 'min': 2, 'max': 6}, {'key': 1, 'min': 4, 'max': 8}] | meanby('key', ['min', 'max'])
+    >>> means == {1: {'min': 3.0, 'max': 7.0}}
+    True
 
     :param: keys ``dict`` keys for the values to aggregate on
     :params: values ``dict`` keys for the values to be aggregated
+    :param columnar: If True, use numpy to add up the values in chunks (see ``sumby``)
+    :param chunksize: The number of tokens to add up at once if ``columnar`` is set
     :return: dict mapping each key to the sum of all the values corresponding to that key
     """
-    counts={}
-    totals={}
-    if keys and values:
-        values=_wrapInIterable(values)
-        for data in tokens:
-            aggkey=data[keys] if isinstance(keys, string_types) else tuple(data[key] for key in _wrapInIterable(keys))
-            for value in values:
-                counts[aggkey]=counts.get(aggkey, 0)+1
-                totals.setdefault(aggkey, {})[value]=totals.get(aggkey, {}).get(value, 0)+data[value]
-        return dict((key, dict((value, totals[key][value]/counts[key]) for value in values)) for key in totals)
-    else:
-        for (key, value) in tokens:
-            counts[key]=counts.get(key, 0)+1
-            totals[key]=totals.get(key, 0)+value
-        return dict((key, totals[key]/counts[key]) for key in counts)
+    return MeanBy(keys, values, columnar, chunksize).update(tokens).result()
+
+__test__['columnar']='''
+Columnar ``sumby`` and ``meanby`` need numpy, so these are skipped (rather than passed without checking anything) if it
+isn't installed
+
+>>> import pytest, random
+>>> numpy=pytest.importorskip('numpy')
+>>> data=[{'Region': random.choice(['North', 'West']), 'Revenue': random.random(), 'Cost': 1} for i in range(1000)]
+>>> (data | sumby('Region', ['Revenue', 'Cost'], columnar=True, chunksize=300)) == (data | sumby('Region', ['Revenue', 'Cost']))
+True
+>>> pairs=[('A', 1), ('B', 2.5), ('A', 2)] # A mixture of ints and floats is added up in python
+>>> sorted((pairs | sumby(columnar=True)).items()) == sorted((pairs | sumby()).items()) == [('A', 3), ('B', 2.5)]
+True
+>>> data=[{'Region': 'North', 'Revenue': 4, 'Cost': 8}, {'Region': 'North', 'Revenue': 3.5, 'Cost': 2}]
+>>> repr(data | sumby('Region', ['Cost'], columnar=True)) == repr(data | sumby('Region', ['Cost']))
+True
+>>> ([('A', 2), ('B', 6), ('A', 3), ('C', 20), ('C', 10), ('C', 30)] | meanby(columnar=True, chunksize=4)) == {'A': 2.5, 'B': 6, 'C': 20}
+True
+'''
 
 @terminator
 def firstby(keys=None, values=None, tokens=None):
@@ -785,8 +2197,165 @@ def countby(keys, tokens=None):
     >>> counts = [{'A': 6}, {'A': 5}, {'A': 4}] | countby(keys='A')
     >>> dict(counts) == {6: 1, 5: 1, 4: 1}
     True
+    >>> counts = [{'A': 6, 'B': 1}, {'A': 6, 'B': 1}, {'A': 4, 'B': 1}] | countby(keys=['A', 'B'])
+    >>> dict(counts) == {(6, 1): 2, (4, 1): 1}
+    True
+    """
+    return CountBy(keys).update(tokens).result()
+
+def _windowstart(position, step):
+    """Returns the start of the last window (starting at a multiple of ``step``) to begin at or before ``position``"""
+    if isinstance(position, datetime):
+        epoch=datetime(1970, 1, 1, tzinfo=position.tzinfo)
+        return epoch+step*int((position-epoch).total_seconds()//step.total_seconds())
+    return position-position%step
+
+def _panelength(size, step):
+    """
+    Returns the length of the panes that windows of ``size`` starting every ``step`` can be split into (their greatest
+    common divisor), or ``None`` if it can't be worked out (e.g. for ``float``-s)
+    """
+    def gcd(a, b):
+        while b:
+            a, b=b, a%b
+        return a
+    if isinstance(size, integer_types) and isinstance(step, integer_types):
+        return gcd(size, step)
+    if isinstance(size, timedelta) and isinstance(step, timedelta):
+        microseconds=lambda t: (t.days*86400+t.seconds)*1000000+t.microseconds
+        return timedelta(microseconds=gcd(microseconds(size), microseconds(step)))
+    return None
+
+def _asaccumulator(agg):
+    """
+    Returns a new ``Accumulator`` that gives the same result as a ``Terminator`` that is built on one (e.g. ``count()``
+    or ``sumby(keys, values)``), or ``None`` if there isn't one
+    """
+    accumulators={count.func: Count, ssum.func: Sum, smax.func: Max, smin.func: Min, bag.func: Bag,
+                  countby.func: CountBy, sumby.func: SumBy, meanby.func: MeanBy, nlargest.func: NLargest,
+                  nsmallest.func: NSmallest}
+    func=agg.func
+    raw=getattr(func, 'func', func)
+    if raw not in accumulators:
+        return None
+    kwargs=dict((key, value) for key, value in (getattr(func, 'keywords', None) or {}).items() if key!='tokens')
+    try:
+        return accumulators[raw](*getattr(func, 'args', ()), **kwargs)
+    except TypeError: # Let the terminator raise its own error
+        return None
+
+@connector
+def window(agg, size, step=None, time=None, tokens=None):
     """
-    return tokens | smap(lambda x: x[keys if isinstance(keys, string_types) else tuple(data[key] for key in keys)]) | bag()
+    Aggregates the stream in windows, passing on a ``(start, result)`` tuple for each window once it has ended, so that
+    e.g. a stream that never ends (from ``follow``) can be summarised as it goes. Windows are ``size`` tokens long by
+    default, or if ``time`` is set, ``size`` seconds long according to the timestamps of the tokens (which can be
+    numbers, or :py:class:`datetime.datetime` objects in which case ``size`` and ``step`` can also be
+    :py:class:`datetime.timedelta` objects). A new window starts every ``step`` (which is ``size`` by default, giving
+    tumbling windows, less than ``size`` for sliding windows, or more than ``size`` for hopping windows, which skip the
+    tokens between them), aligned to a multiple of ``step`` (so per-minute windows start on the minute).
+
+    If ``agg`` is an ``Accumulator``, or a terminator that is built on one (``count``, ``ssum``, ``smax``, ``smin``,
+    ``bag``, ``countby``, ``sumby``, ``meanby``, ``nlargest`` or ``nsmallest``), the windows are split into panes (of the
+    greatest common divisor of ``size`` and ``step``), each token is added to a copy of it for the pane it falls in, and
+    the panes in each window are merged once it ends, so only a copy for each pane is held in memory. Otherwise, the
+    tokens in the windows that haven't yet ended are held in memory, and ``agg`` is run over all the tokens in each
+    window once it ends, which for long windows (or many sliding windows) costs far more time and memory - so for a
+    custom aggregate, write an ``Accumulator``. Tokens are expected to arrive in time order - any that arrive late are
+    treated as if they had the latest timestamp seen so far. Windows without any tokens in them are skipped, and any
+    windows still open when the stream ends are passed on as they are.
+
+    >>> from streamutils import *
+    >>> range(10) | window(ssum(), 4) | aslist()
+    [(0, 6), (4, 22), (8, 17)]
+    >>> 'abcde' | window(aslist(), 3, step=1) | smap(lambda w: ''.join(w[1])) | aslist()
+    ['abc', 'bcd', 'cde', 'de', 'e']
+    >>> range(10) | window(ssum(), 4, step=2) | aslist() == range(10) | window(sum, 4, step=2) | aslist()
+    True
+    >>> range(10) | window(ssum(), 2, step=5) | aslist() == range(10) | window(sum, 2, step=5) | aslist()
+    True
+    >>> range(10) | window(ssum(), 2, step=5) | aslist()
+    [(0, 1), (5, 11)]
+    >>> log=[{'time': 0, 'status': 200}, {'time': 30, 'status': 404}, {'time': 59, 'status': 200},
+    ...      {'time': 70, 'status': 200}, {'time': 250, 'status': 500}]
+    >>> for start, counts in log | window(CountBy('status'), 60, time='time'):
+    ...     print(start, sorted(counts.items()))
+    0 [(200, 2), (404, 1)]
+    60 [(200, 1)]
+    240 [(500, 1)]
+    >>> from datetime import datetime, timedelta
+    >>> times=[datetime(2016, 1, 1, 12, 0, 10), datetime(2016, 1, 1, 12, 0, 50), datetime(2016, 1, 1, 12, 1, 5)]
+    >>> times | window(count(), timedelta(minutes=1), step=30, time=lambda t: t) | smap(lambda w: (str(w[0]), w[1])) | aslist()
+    [('2016-01-01 11:59:30', 1), ('2016-01-01 12:00:00', 2), ('2016-01-01 12:00:30', 2), ('2016-01-01 12:01:00', 1)]
+
+    :param agg: ``Accumulator`` (e.g. ``Count()`` or ``CountBy(keys)``), which is copied for each pane, or
+        ``Terminator`` (e.g. ``count()``, ``sumby()`` or ``countby(keys)``) to aggregate the tokens in each window with,
+        or a function that takes a ``list`` of them
+    :param size: The length of each window, in tokens, or if ``time`` is set, in seconds (or as a ``timedelta``)
+    :param step: How often a new window starts (by default ``size``, so that windows don't overlap)
+    :param time: ``dict`` key or attribute holding each token's timestamp, or a function that returns it
+    :param tokens: The items in the pipeline
+    """
+    step=step or size
+    if isinstance(agg, Terminator):
+        agg=_asaccumulator(agg) or agg
+    accumulating=isinstance(agg, Accumulator)
+    if accumulating:
+        import copy
+    if time is None:
+        positions=icount()
+    else:
+        gettime=time if callable(time) else lambda token: getattr(token, time) if hasattr(token, time) else token[time]
+        positions=None
+    def aggregate(start):
+        if accumulating: # Merge the panes that make up the window
+            result=copy.deepcopy(agg)
+            for panestart, pane in panes:
+                if start<=panestart<start+size:
+                    result.merge(pane)
+            return result.result()
+        windowed=[t for p, t in buffered if start<=p<start+size]
+        return windowed | agg if isinstance(agg, Terminator) else agg(windowed)
+    buffered=deque() # (position, token) for each token in the windows that are still open
+    starts=deque() # The start of each window that is still open
+    panes=deque() # If agg is an Accumulator, (start, copy of agg) for each pane of the windows that are still open
+    latest=None
+    panelength=_panelength(size, step)
+    for token in tokens:
+        position=next(positions) if positions else gettime(token)
+        if latest is not None and position<latest:
+            position=latest
+        latest=position
+        if isinstance(position, datetime) and not (isinstance(size, timedelta) and isinstance(step, timedelta)):
+            size, step=[t if isinstance(t, timedelta) else timedelta(seconds=t) for t in (size, step)]
+            panelength=_panelength(size, step)
+        while starts and starts[0]+size<=position:
+            start=starts.popleft()
+            yield (start, aggregate(start))
+        start=_windowstart(position-size, step)+step # The first window this token is in
+        if time is None and start<0:
+            start=0
+        if starts and start<=starts[-1]: # Only open windows that aren't open already
+            start=starts[-1]+step
+        while start<=position:
+            starts.append(start)
+            start=start+step
+        if not starts: # The token is in the gap between two windows
+            continue
+        if accumulating:
+            while panes and panes[0][0]<starts[0]:
+                panes.popleft()
+            panestart=_windowstart(position, panelength) if panelength else position
+            if not panes or panestart>panes[-1][0]:
+                panes.append((panestart, copy.deepcopy(agg)))
+            panes[-1][1].add(token)
+            continue
+        while buffered and buffered[0][0]<starts[0]:
+            buffered.popleft()
+        buffered.append((position, token))
+    while starts:
+        start=starts.popleft()
+        yield (start, aggregate(start))
 
 @terminator
 def bag(tokens=None):
@@ -802,7 +2371,119 @@ def bag(tokens=None):
     :param tokens: list of items to count
     :return: A :py:class:`collections.Counter`
     """
-    return Counter(tokens)
+    return Bag().update(tokens).result()
+
+def _hllsigma(x):
+    if x==1:
+        return float('inf')
+    y, z=1.0, x
+    while True:
+        x*=x
+        previous, z=z, z+x*y
+        y+=y
+        if z==previous:
+            return z
+
+def _hlltau(x):
+    if x==0 or x==1:
+        return 0.0
+    y, z=1.0, 1-x
+    while True:
+        x=math.sqrt(x)
+        y*=0.5
+        previous, z=z, z-(1-x)**2*y
+        if z==previous:
+            return z/3
+
+@terminator
+def countdistinct(precision=14, tokens=None):
+    """
+    Estimates the number of different values in the stream (``count(distinct ...)`` in SQL) using a HyperLogLog sketch,
+    which only needs ``2**precision`` bytes of memory however many values there are. The standard error of the estimate
+    is about ``1.04/2**(precision/2)``, i.e. 0.8% for the default precision of ``14`` (which uses 16kB). Values are
+    hashed from their type and their bytes (or their ``repr``), so the estimate is the same every time. Only hashable
+    scalars (numbers, strings, ``bytes``, ``None``, dates) and tuples of them are supported, and values that are equal
+    (``==``) but of different types (e.g. ``1`` and ``1.0``) will be counted as different
+
+    >>> from streamutils import *
+    >>> ['one', 'two', 'two', 'three', 'three', 'three', 'one'] | countdistinct()
+    3
+    >>> [1, '1', 1.0, (1,), '1'] | countdistinct()
+    4
+    >>> abs((range(1000000) | smap(lambda x: x % 200000) | countdistinct()) - 200000) < 200000*0.03
+    True
+
+    :param precision: log2 of the number of registers in the sketch (between 4 and 18)
+    :param tokens: The items in the pipeline
+    :return: the estimated number of distinct items as an ``int``
+    """
+    if not 4<=precision<=18:
+        raise ValueError('precision must be between 4 and 18, not %r' % precision)
+    m=1<<precision
+    q=64-precision
+    rest=(1<<q)-1
+    registers=bytearray(m)
+    stablehash=_stablehasher()
+    for token in tokens:
+        h=stablehash(token)
+        rank=q-(h & rest).bit_length()+1
+        if rank>registers[h>>q]:
+            registers[h>>q]=rank
+    # Ertl's estimator ("New cardinality estimation algorithms for HyperLogLog sketches", 2017) doesn't need the bias
+    # correction tables that the original estimator does for small cardinalities
+    counts=Counter(registers)
+    z=m*_hlltau(1-counts[q+1]/m)
+    for k in range(q, 0, -1):
+        z=0.5*(z+counts[k])
+    z+=m*_hllsigma(counts[0]/m)
+    return int(round(m*m/(2*math.log(2)*z)))
+
+@terminator
+def heavyhitters(k=10, capacity=None, tokens=None):
+    """
+    Estimates the ``k`` most common values in the stream and how often they occur (like ``bag() .most_common(k)``), using
+    the Space-Saving algorithm so that only ``capacity`` counts (``10*k`` by default) are kept in memory rather than one
+    for each different value. Counts can be overestimated by at most ``n/capacity`` for a stream of ``n`` items, so a
+    value that makes up more than that fraction of the stream will always be found. Values with the same count are
+    returned in sorted order (if they can be compared)
+
+    >>> from streamutils import *
+    >>> ['one', 'two', 'two', 'three', 'three', 'three', 'one'] | heavyhitters(2)
+    [('three', 3), ('one', 2)]
+    >>> range(100000) | smap(lambda x: x if x % 4 else x % 3) | heavyhitters(3) | smap(lambda pair: pair[0]) | ssorted()
+    [0, 1, 2]
+
+    :param k: The number of values to return
+    :param capacity: The number of values to keep counts for
+    :param tokens: The items in the pipeline
+    :return: A ``list`` of ``(value, estimated count)`` tuples, most common first
+    """
+    import heapq
+    capacity=capacity or 10*k
+    counts={}
+    heap=[] # (count, order, token) for each count (out of date entries are skipped over and cleared out now and then)
+    order=icount()
+    for token in tokens:
+        if token in counts:
+            counts[token]+=1
+        elif len(counts)<capacity:
+            counts[token]=1
+        else:
+            while True:
+                least, _, evicted=heapq.heappop(heap)
+                if counts.get(evicted)==least:
+                    break
+            del counts[evicted]
+            counts[token]=least+1
+        heapq.heappush(heap, (counts[token], next(order), token))
+        if len(heap)>2*capacity:
+            heap=[(c, next(order), t) for t, c in counts.items()]
+            heapq.heapify(heap)
+    try: # Break ties by value, so that the result doesn't depend on the order of the dict
+        ranked=sorted(counts.items(), key=lambda pair: (-pair[1], pair[0]))
+    except TypeError: # Values that can't be compared with each other
+        ranked=sorted(counts.items(), key=lambda pair: pair[1], reverse=True)
+    return ranked[:k]
 
 @terminator
 def action(func, tokens=None):
@@ -831,11 +2512,83 @@ def sreduce(func, initial=None, tokens=None):
     """
     return reduce(func, tokens, initial)
 
+def _joinlines(lines, newlines=False, strip=False):
+    """
+    Joins a chunk of lines into one string to write out in one go (adding a newline to the end of each line if
+    ``newlines`` is set and it doesn't already have one, or stripping trailing whitespace and adding a newline if ``strip``
+    is set), or returns ``None`` if they're not all the same kind of string
+    """
+    kind=type(lines[0])
+    if not isinstance(lines[0], (bytes, ) + string_types):
+        return None
+    newline=b'\n' if kind==bytes else kind('\n')
+    try:
+        if strip:
+            return newline.join(map(kind.rstrip, lines))+newline
+        if newlines:
+            if not any(map(kind.endswith, lines, repeat(newline))):
+                return newline.join(lines)+newline
+            if not all(map(kind.endswith, lines, repeat(newline))):
+                lines=map(_addnewline, lines)
+        return newline[:0].join(lines)
+    except TypeError: # Not all the same type
+        return None
+
+def _writeprinted(line):
+    """Writes a line to stdout like ``print`` would"""
+    if isinstance(line, bytes):
+        sys.stdout.flush()
+        stdout=getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(line.rstrip()+b'\n')
+        stdout.flush()
+    else:
+        print(line.rstrip() if isinstance(line, string_types) else line)
+
+def _isatty(f):
+    try:
+        return f.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def _writechunks(f, tokens, buffersize, newlines, flush=False):
+    """Writes tokens to a file ``buffersize`` at a time (flushing the file after each chunk if ``flush`` is set)"""
+    while True:
+        chunk=list(islice(tokens, buffersize))
+        if not chunk:
+            return
+        text=_joinlines(chunk, newlines)
+        if text is None or not hasattr(f, 'write'):
+            f.writelines(map(_addnewline, chunk) if newlines else chunk)
+        else:
+            f.write(text)
+        if flush and hasattr(f, 'flush'):
+            f.flush()
+
+_live = set() # Functions of sources that wait for more tokens rather than ending (e.g. follow)
+
+def _islive(tokens):
+    """Returns True if a pipeline starts with a source that waits for more tokens rather than ending (e.g. ``follow``)"""
+    while isinstance(tokens, Connector):
+        func=tokens.func
+        if getattr(func, 'func', func) in _live:
+            return True
+        tokens=func.keywords.get(tokens.tokenskw) if isinstance(func, partial) else None
+    return False
+
 @terminator
-def write(fname=None, mode='wt', encoding=None, tokens=None):
+def write(fname=None, mode='wt', encoding=None, buffersize=None, newlines=False, tokens=None):
     r"""
     Writes the output of the stream to a file, or via ``print`` if no file is supplied. Calls to ``print`` include
-    a call to :py:func:`str.rstrip` to remove trailing newlines. ``mode`` is only used if ``fname`` is a string
+    a call to :py:func:`str.rstrip` to remove trailing newlines. ``mode`` is only used if ``fname`` is a string, and
+    if the tokens are ``bytes`` the file is opened in binary mode. If ``fname`` ends in ``.gz``, ``.bz2`` or ``.xz``, the
+    file is compressed as it is written.
+
+    Tokens are gathered up ``buffersize`` (by default 1000) at a time and written out in one go, unless writing to a
+    terminal (when each token is written as soon as it arrives). If the stream comes from a source that waits for more
+    tokens rather than ending (``follow`` or ``afollow``), each token is written out and flushed as soon as it arrives
+    by default, so that e.g. ``grep`` or ``tee`` at the other end of a shell pipe sees it straight away. Set
+    ``buffersize`` to 1 if something else needs to see each token as soon as it is written (e.g. for ``run`` of a
+    command that keeps running)
 
     >>> from streamutils import *
     >>> from six import StringIO
@@ -849,31 +2602,173 @@ def write(fname=None, mode='wt', encoding=None, tokens=None):
     >>> writtenlines=buffer.getvalue().splitlines()
     >>> writtenlines[0]=='Three'
     True
+    >>> import os, tempfile
+    >>> fname=os.path.join(tempfile.mkdtemp(), 'mice.txt.gz')
+    >>> ['Three', 'Blind', 'Mice'] | head() > fname
+    >>> read(fname) | strip() | write()
+    Three
+    Blind
+    Mice
+    >>> os.remove(fname)
+    >>> import threading, time
+    >>> class Shown(object): # Records what has been written, like whatever is at the other end of a pipe
+    ...     def __init__(self):
+    ...         self.lines=[]
+    ...     def write(self, text):
+    ...         self.lines.append(text)
+    >>> shown, seen=Shown(), []
+    >>> def logger(): # Adds a second line to the file once the first one has been written (or after 5 seconds)
+    ...     time.sleep(0.2)
+    ...     with open(fname, 'ab') as f:
+    ...         w=f.write(b'Three\n')
+    ...     deadline=time.time()+5
+    ...     while not shown.lines and time.time()<deadline:
+    ...         time.sleep(0.01)
+    ...     seen.append(len(shown.lines))
+    ...     with open(fname, 'ab') as f:
+    ...         w=f.write(b'Blind\n')
+    >>> open(fname, 'w').close()
+    >>> writer=threading.Thread(target=logger)
+    >>> writer.start()
+    >>> follow(fname, interval=0.1) | head(2) | strip() | write(shown, newlines=True)
+    >>> writer.join()
+    >>> print(seen[0], ' '.join(''.join(shown.lines).split()))
+    1 Three Blind
+    >>> os.remove(fname)
 
     :param fname: If `str`, filename to write to, otherwise open file-like object to write to. Default of `None` implies
                     write to standard output
     :param mode: The mode to use to open ``fname`` (default of 'wt' as per :py:func:`io.open`)
     :param encoding: Encoding to use to write to the file
+    :param buffersize: The number of tokens to write at once (default: 1000, or 1 if the stream comes from ``follow``)
+    :param newlines: If True, add a newline to the end of each token that doesn't already end with one
     :param tokens: Lines to write to the file
     """
+    live=_islive(tokens)
+    buffersize=buffersize or (1 if live else 1000)
+    tokens=iter(tokens)
     if not fname:
-        for line in tokens:
-            print(line.rstrip() if isinstance(line, string_types) else line)
+        buffersize=1 if _isatty(sys.stdout) else buffersize
+        while True:
+            chunk=list(islice(tokens, buffersize))
+            if not chunk:
+                return
+            text=_joinlines(chunk, strip=True)
+            if text is None:
+                for line in chunk:
+                    _writeprinted(line)
+            elif isinstance(text, bytes):
+                sys.stdout.flush()
+                stdout=getattr(sys.stdout, 'buffer', sys.stdout)
+                stdout.write(text)
+                stdout.flush()
+            else:
+                sys.stdout.write(text)
+            if live:
+                sys.stdout.flush()
     elif isinstance(fname, string_types):
-        with open(fname, encoding=encoding, mode=mode) as f:
-            f.writelines(tokens)
-    elif hasattr(fname, 'writelines'):
-        fname.writelines(tokens)
-    elif hasattr(fname, 'write'):
-        for line in tokens:
-            fname.write(line)
+        first=next(tokens, _nothing)
+        if isinstance(first, bytes) and 'b' not in mode: # Write bytes without encoding them
+            mode, encoding=mode.replace('t', '')+'b', None
+        tokens=ichain([first], tokens) if first is not _nothing else tokens
+        ext=os.path.splitext(fname)[1]
+        if ext in _compressors:
+            _compressedwrite(fname, ext, mode, encoding, None, None, None, buffersize, newlines, tokens)
+        else:
+            with open(fname, encoding=encoding, mode=mode) as f:
+                _writechunks(f, tokens, buffersize, newlines, live)
+    elif hasattr(fname, 'write') or hasattr(fname, 'writelines'):
+        _writechunks(fname, tokens, 1 if _isatty(fname) else buffersize, newlines, live)
     else:
         raise TypeError('fname must be a filename or a file-like thing, got %s which is a %s' % (fname, type(fname)))
 
+def _stablehasher():
+    """
+    Returns a function that hashes a token to 64 well mixed bits from a digest of the name of its type and its bytes (or
+    its ``repr``), so that unlike ``hash`` (which is salted for strings on python 3, and is just the ``int`` for an
+    ``int``) the hash is the same in every process. Only hashable scalars (numbers, strings, ``bytes``, ``None``, dates)
+    and tuples of them are supported, as the ``repr`` of e.g. a ``frozenset`` depends on the order its items were added
+    """
+    import hashlib
+    digest=partial(hashlib.blake2b, digest_size=8) if hasattr(hashlib, 'blake2b') else hashlib.md5
+    def stablehash(token):
+        if isinstance(token, bytes):
+            data=token
+        elif isinstance(token, string_types):
+            data=token.encode('utf-8')
+        else:
+            data=repr(token).encode('utf-8')
+        return int(digest(type(token).__name__.encode('utf-8')+b'\0'+data).hexdigest()[:16], 16)
+    return stablehash
+
+class _BloomFilter(object):
+    """A set that can say an item is in it when it isn't (with probability ``error``), but only needs ~1 byte per item"""
+    def __init__(self, capacity, error):
+        self.capacity=capacity
+        self.size=int(math.ceil(-capacity*math.log(error)/math.log(2)**2))
+        self.hashes=max(1, int(round(self.size/capacity*math.log(2))))
+        self.bits=bytearray((self.size+7)//8)
+        self.count=0
+
+    def __contains__(self, h):
+        bits, size=self.bits, self.size
+        # Double hashing with the two halves of the hash, as in Kirsch & Mitzenmacher
+        bit, step=(h & 0xFFFFFFFF)%size, ((h >> 32) | 1)%size
+        for i in range(self.hashes):
+            if not bits[bit>>3] & (1 << (bit & 7)):
+                return False
+            bit+=step
+            if bit>=size:
+                bit-=size
+        return True
+
+    def add(self, h):
+        """Adds a hash to the filter, returning False if it (probably) was already there"""
+        bits, size=self.bits, self.size
+        bit, step=(h & 0xFFFFFFFF)%size, ((h >> 32) | 1)%size
+        new=False
+        for i in range(self.hashes):
+            mask=1 << (bit & 7)
+            if not bits[bit>>3] & mask:
+                bits[bit>>3]|=mask
+                new=True
+            bit+=step
+            if bit>=size:
+                bit-=size
+        self.count+=new
+        return new
+
+class _ScalableBloomFilter(object):
+    """
+    A Bloom filter that doesn't need to know how many items will be added: once one filter is full, another twice as big
+    is added with half the error rate, so the overall error rate stays below ``error``
+    """
+    def __init__(self, capacity, error):
+        self.filters=[_BloomFilter(capacity, error/2)]
+        self.hash=_stablehasher()
+
+    def add(self, token):
+        """Adds token to the filter, returning False if it (probably) was already there"""
+        h=self.hash(token)
+        last=self.filters[-1]
+        for f in self.filters[:-1]:
+            if h in f:
+                return False
+        if not last.add(h):
+            return False
+        if last.count>=last.capacity:
+            self.filters.append(_BloomFilter(last.capacity*2, math.exp(-last.size/last.capacity*math.log(2)**2)/2))
+        return True
+
 @connector
-def unique(tokens=None):
+def unique(tokens=None, approx=False, error=0.01, capacity=1000000):
     """
-    Passes through values the first time they are seen
+    Passes through values the first time they are seen. By default, every value seen is kept in a ``set``, which can
+    use a lot of memory if there are a lot of different values. If ``approx`` is ``True``, a (scalable) Bloom filter is
+    used instead, which needs about 10 bits per value for a 1% ``error`` (so 1.2MB for the first million values) but will
+    drop a value that hasn't been seen before with a probability of (at most) ``error``, and is several times slower.
+    ``approx`` only supports hashable scalars (numbers, strings, ``bytes``, ``None``, dates) and tuples of them, and
+    values of different types (e.g. ``1`` and ``1.0``) are always treated as different
 
     >>> from streamutils import *
     >>> lines=['one', 'two', 'two', 'three', 'three', 'three', 'one']
@@ -881,9 +2776,22 @@ def unique(tokens=None):
     one
     two
     three
+    >>> 0.99 < (range(200000) | unique(approx=True, capacity=10000) | count())/200000 <= 1
+    True
+    >>> [1, '1', 1.0, '1'] | unique(approx=True) | aslist()
+    [1, '1', 1.0]
 
     :param tokens: Either set by the pipeline or provided as an initial list of items to pass through the pipeline
+    :param approx: If ``True``, use a Bloom filter to remember which values have been seen rather than a ``set``
+    :param error: The highest acceptable chance of dropping a value that hasn't been seen before if ``approx`` is ``True``
+    :param capacity: The number of different values to size the first Bloom filter for (more are added as needed)
     """
+    if approx:
+        seen=_ScalableBloomFilter(capacity, error)
+        for line in tokens:
+            if seen.add(line):
+                yield line
+        return
     s=set()
     for line in tokens:
         if line not in s:
@@ -891,7 +2799,7 @@ def unique(tokens=None):
             yield line
 
 @connector
-def head(n=10, fname=None, skip=0, encoding=None, tokens=None):
+def head(n=10, fname=None, skip=0, encoding=None, binary=False, tokens=None):
     """
     (Optionally) opens a file and passes through the first ``n`` items
 
@@ -916,11 +2824,12 @@ def head(n=10, fname=None, skip=0, encoding=None, tokens=None):
     :param fname: Filename (or filenames) to open
     :param skip: Number of lines to skip before returning lines
     :param encoding: Encoding of file to open. If None, will try to guess the encoding based on coding= strings
+    :param binary: If True, read ``bytes`` from the file without decoding them
     :param tokens: Stream of tokens to take the first few members of (i.e. not a list of filenames to take the first few lines of)
     """
     fnames=_wrapInIterable(fname) or [iter(tokens)] #Bit ugly, but we want to make sure iterating through tokens skips them, even if tokens is a list
     for name in fnames:
-        with _eopen(name, encoding) if fname else _noopcontext(name) as tokens: #in the else case, name is actually the tokens originally passed
+        with _eopen(name, encoding, binary) if fname else _noopcontext(name) as tokens: #in the else case, name is actually the tokens originally passed
             if isinstance(n, integer_types):
                 for line in islice(tokens, skip, skip+n if n else MAXSIZE):
                     yield line
@@ -939,7 +2848,8 @@ def head(n=10, fname=None, skip=0, encoding=None, tokens=None):
 @connector
 def tail(n=10, fname=None, encoding=None, tokens=None):
     """
-    Returns a list of the last ``n`` items in the stream
+    Returns a list of the last ``n`` items in the stream. If ``fname`` is an uncompressed local file, it is memory-mapped
+    and scanned backwards from the end, so only the last few lines are read (not the whole file)
 
     >>> tokens="hi ho hi ho it's off to work we go".split()
     >>> tail(5, tokens=tokens) | write()    #Note tail() returns a deque not a generator, but it still works as part of a stream
@@ -958,9 +2868,55 @@ def tail(n=10, fname=None, encoding=None, tokens=None):
     :param tokens: Stream of tokens to take the last few members of (i.e. not a list of filenames to take the last few lines of)
     :return: A list of the last ``n`` items
     """
+    if fname and _isplainfile(fname):
+        return _tailfile(fname, n, encoding)
     with _eopen(fname, encoding) if fname else _noopcontext(tokens) as tokens:
         return deque(tokens, n)
 
+def _isplainfile(fname):
+    '''Returns True if fname is a local file that _eopen would read without decompressing it'''
+    return not re.search('^[a-z+]+[:][/]{2}', fname) and os.path.isfile(fname) \
+        and os.path.splitext(fname)[1] not in ['.gz', '.gzip', '.bz2', '.xz']
+
+def _tailfile(fname, n, encoding=None):
+    r'''
+    Returns the last ``n`` lines of an uncompressed file by memory-mapping it and scanning backwards from the end for
+    newlines, so that only the end of the file is read
+
+    >>> import tempfile, shutil
+    >>> d=tempfile.mkdtemp()
+    >>> try:
+    ...     name=os.path.join(d, 'lines.txt')
+    ...     with open(name, 'wb') as f:
+    ...         w=f.write(b'one\r\ntwo\nthree')
+    ...     print(list(_tailfile(name, 2))==['two\n', 'three'])
+    ...     print('|'.join(_tailfile(name, 5)).replace('\n', ''))
+    ...     with open(name, 'wb') as f:
+    ...         pass
+    ...     print(len(_tailfile(name, 5)))
+    ... finally:
+    ...     shutil.rmtree(d)
+    True
+    one|two|three
+    0
+    '''
+    import mmap, io
+    with open(fname, 'rb') as f:
+        size=os.fstat(f.fileno()).st_size
+        if not size or n<=0:
+            return deque([], max(n, 0))
+        m=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start=size-1 if m[size-1:size]==b'\n' else size # A trailing newline doesn't start another line
+            for i in range(n):
+                start=m.rfind(b'\n', 0, start)
+                if start<0:
+                    break
+            data=m[start+1:]
+        finally:
+            m.close()
+    return deque(io.StringIO(data.decode(_encoding(encoding)), newline=None), n)
+
 @connector
 def sslice(start=1, stop=None, step=1, fname=None, encoding=None, tokens=None):
     """
@@ -987,25 +2943,283 @@ def sslice(start=1, stop=None, step=1, fname=None, encoding=None, tokens=None):
         for line in islice(tokens, start-1, stop-1 if stop else None, step):
             yield line  # Can't return the iterator or the file will be closed (I think!)
 
-@connector
-def follow(fname, encoding=None): #pragma: no cover - runs forever!
+class _FollowedFile(object):
+    """
+    Reads the lines that have been appended to a file since it was last polled. If the file is truncated it is read again
+    from the start, and if it is replaced (e.g. by logrotate) the new file is opened once the rest of the old file has been
+    read. A line is only returned once its newline has been written (or the file has been replaced)
+    """
+    def __init__(self, fname, encoding=None, end=True):
+        self.fname=fname
+        self.encoding=_encoding(encoding)
+        self.f=None
+        self._open(end)
+
+    def _open(self, end):
+        try:
+            self.f=open(self.fname, 'rb')
+        except (IOError, OSError): # Doesn't exist (yet)
+            self.f=None
+            return
+        stat=os.fstat(self.f.fileno())
+        self.inode=(stat.st_dev, stat.st_ino)
+        self.pos=stat.st_size if end else 0
+        self.f.seek(self.pos)
+        self._reset()
+
+    def _reset(self):
+        from io import IncrementalNewlineDecoder
+        import codecs
+        self.decoder=IncrementalNewlineDecoder(codecs.getincrementaldecoder(self.encoding)(), translate=True)
+        self.rest=''
+
+    def _read(self, final=False):
+        data=self.f.read()
+        self.pos+=len(data)
+        lines=(self.rest+self.decoder.decode(data, final=final)).split('\n')
+        self.rest=lines.pop()
+        lines=[line+'\n' for line in lines]
+        if final and self.rest:
+            lines.append(self.rest)
+            self.rest=''
+        return lines
+
+    def poll(self):
+        if self.f is None:
+            self._open(end=False) # The file has appeared since we started, so all of it is new
+            if self.f is None:
+                return []
+        lines=self._read()
+        try:
+            stat=os.stat(self.fname)
+        except (IOError, OSError): # Moved away, and not replaced yet
+            return lines
+        if (stat.st_dev, stat.st_ino)!=self.inode:
+            lines.extend(self._read(final=True))
+            self.f.close()
+            self._open(end=False)
+            if self.f:
+                lines.extend(self._read())
+        elif stat.st_size<self.pos: # Truncated
+            self.f.seek(0)
+            self.pos=0
+            self._reset()
+            lines.extend(self._read())
+        return lines
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+_IN_MODIFY, _IN_MOVED_FROM, _IN_MOVED_TO, _IN_CREATE, _IN_DELETE, _IN_Q_OVERFLOW = 0x2, 0x40, 0x80, 0x100, 0x200, 0x4000
+
+def _inotify(dirs):
+    """
+    Returns an inotify file descriptor (set to non-blocking) that watches for files in ``dirs`` being changed, created,
+    moved or deleted, and a ``dict`` mapping each of its watch descriptors to the directory it watches. Returns
+    ``(None, {})`` where inotify isn't available
+    """
+    if not sys.platform.startswith('linux'): #pragma: no cover
+        return None, {}
+    import ctypes
+    try:
+        libc=ctypes.CDLL(None, use_errno=True)
+        fd=libc.inotify_init1(0o4000 | 0o2000000) # IN_NONBLOCK | IN_CLOEXEC
+    except (OSError, AttributeError): #pragma: no cover
+        return None, {}
+    if fd<0: #pragma: no cover
+        return None, {}
+    watches={}
+    for d in dirs:
+        wd=libc.inotify_add_watch(fd, d if isinstance(d, bytes) else d.encode(sys.getfilesystemencoding()),
+                                  _IN_MODIFY | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+        if wd<0: #pragma: no cover - e.g. out of watches, so poll instead
+            os.close(fd)
+            return None, {}
+        watches[wd]=d
+    return fd, watches
+
+class _Follower(object):
+    """
+    Follows a file, a list of files or glob patterns (used by ``follow`` and ``streamutils.aio.afollow``). ``poll``
+    returns the new lines in any of the files (including files that have started to match one of the glob patterns), and
+    ``wait`` waits for one of them to change. On linux, changes are waited for with inotify (checking every ``interval``
+    seconds in case an event was missed, e.g. on a network filesystem), elsewhere the files are polled, starting quickly
+    after they last changed and backing off to every ``interval`` seconds
     """
-    Monitor a file, reading new lines as they are added (equivalent of ``tail -f`` on UNIX). (Note: Never returns)
+    def __init__(self, fname, encoding=None, interval=1):
+        patterns=[os.path.abspath(pattern) for pattern in ([fname] if isinstance(fname, string_types) else fname)]
+        self.encoding=encoding
+        self.globs=[pattern for pattern in patterns if re.search('[*?[]', pattern)]
+        self.files=OrderedDict((name, _FollowedFile(name, encoding)) for pattern in patterns
+                               for name in (sorted(glob.glob(pattern)) if pattern in self.globs else [pattern]))
+        self.interval=interval
+        self.mindelay=self.delay=min(0.05, interval)
+        dirs=set(os.path.dirname(name) for name in list(self.files)+patterns)
+        self.fd, self.watches=_inotify(sorted(d for d in dirs if os.path.isdir(d) and not re.search('[*?[]', d)))
+
+    def fileno(self):
+        """The inotify file descriptor to wait on, or ``None`` if the files have to be polled"""
+        return self.fd
+
+    def poll(self):
+        for pattern in self.globs:
+            for name in sorted(glob.glob(pattern)):
+                if name not in self.files: # A new file, so all of it is new
+                    self.files[name]=_FollowedFile(name, self.encoding, end=False)
+        lines=[]
+        for followed in self.files.values():
+            lines.extend(followed.poll())
+        self.delay=self.mindelay if lines else min(self.delay*2, self.interval)
+        return lines
+
+    def changed(self):
+        """Reads the pending inotify events and returns whether any of them were for the files being followed"""
+        import struct, fnmatch
+        changed=False
+        while True:
+            try:
+                data=os.read(self.fd, 65536)
+            except (IOError, OSError): # Nothing more to read
+                return changed
+            offset=0
+            while offset<len(data):
+                wd, mask, cookie, length=struct.unpack_from('iIII', data, offset)
+                name=data[offset+16:offset+16+length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+                offset+=16+length
+                path=os.path.join(self.watches.get(wd, ''), name)
+                changed=changed or mask & _IN_Q_OVERFLOW or path in self.files or \
+                        any(fnmatch.fnmatch(path, pattern) for pattern in self.globs)
+
+    def wait(self):
+        """Waits until one of the files might have changed"""
+        if self.fd is None:
+            time.sleep(self.delay)
+        else:
+            import select
+            deadline=time.time()+self.interval
+            while select.select([self.fd], [], [], max(0, deadline-time.time()))[0] and not self.changed():
+                pass
 
-    :param fname: File to read
+    def close(self):
+        for followed in self.files.values():
+            followed.close()
+        if self.fd is not None:
+            os.close(self.fd)
+
+@connector
+def follow(fname, encoding=None, interval=1):
+    r"""
+    Monitor a file, reading new lines as they are added (equivalent of ``tail -F`` on UNIX). If the file is truncated, it
+    is read again from the start, and if it is replaced (e.g. by logrotate) or doesn't exist yet, the new file is read
+    once it appears. ``fname`` can also be a ``list`` of files or a glob pattern, in which case lines are passed on from
+    whichever file they are added to. On linux, inotify is used to wait for the files to change, elsewhere they are
+    polled. (Note: Never returns, so use e.g. ``head`` to stop)
+
+    >>> import os, shutil, tempfile, threading, time
+    >>> from streamutils import *
+    >>> d=tempfile.mkdtemp()
+    >>> log=os.path.join(d, 'app.log')
+    >>> def logrotate():
+    ...     time.sleep(0.2)
+    ...     with open(log, 'ab') as f:
+    ...         w=f.write(b'Doc\n')
+    ...     time.sleep(0.2)
+    ...     os.rename(log, log+'.1')
+    ...     with open(log, 'wb') as f:
+    ...         w=f.write(b'Grumpy\n')
+    ...     time.sleep(0.2)
+    ...     with open(log, 'wb') as f:
+    ...         w=f.write(b'Happy\n')
+    >>> with open(log, 'wb') as f:
+    ...     w=f.write(b'Sneezy\n')
+    >>> writer=threading.Thread(target=logrotate)
+    >>> writer.start()
+    >>> follow(log, interval=0.1) | head(3) | strip() | write()
+    Doc
+    Grumpy
+    Happy
+    >>> writer.join()
+    >>> shutil.rmtree(d)
+
+    :param fname: File (or ``list`` of files, or glob pattern) to read
     :param encoding: encoding to use to read the file
+    :param interval: maximum number of seconds to wait before checking the files again
     """
-    with _eopen(fname, encoding) as f:
-        f.seek(0, os.SEEK_END)
+    with closing(_Follower(fname, encoding, interval)) as follower:
         while True:
-            line = f.readline()
-            if not line:
-                time.sleep(1)
-                continue
-            yield line
+            lines=follower.poll()
+            for line in lines:
+                yield line
+            if not lines:
+                follower.wait()
+
+_live.add(follow.func)
+
+_isodate=getattr(date, 'fromisoformat', lambda text: datetime.strptime(text, '%Y-%m-%d').date())
+_isodatetime=getattr(datetime, 'fromisoformat', lambda text: datetime.strptime(text, '%Y-%m-%dT%H:%M:%S'))
+_csvtypes={str: None, date: _isodate, datetime: _isodatetime} # How to convert a csv field to each type (None for no need)
+
+def _rowparser(indexes, converters, make=None):
+    """
+    Compiles a function that picks the fields at ``indexes`` out of a row and converts them with ``converters`` (``None``
+    for no conversion), leaving empty fields as ``None``, and returns them as a ``tuple`` (or passes them to ``make``)
+
+    >>> _rowparser([2, 0], [int, None])(['a', 'b', '3'])
+    (3, 'a')
+    """
+    namespace={'make': make}
+    fields=[]
+    for i, (index, converter) in enumerate(zip(indexes, converters)):
+        if converter is None:
+            fields.append('row[%d]' % index)
+        else:
+            namespace['c%d' % i]=converter
+            fields.append('(c%d(row[%d]) if row[%d] else None)' % (i, index, index))
+    source='def parse(row):\n    return %s' % (('make(%s)' if make else '(%s,)') % ', '.join(fields) if fields else '()')
+    exec(source, namespace)
+    return namespace['parse']
+
+def _typedrows(reader, columns, schema, names):
+    """Passes on the ``columns`` of each row from a :py:func:`csv.reader`, converted according to ``schema``"""
+    header=list(names) if names else None
+    byname=lambda keys: any(isinstance(key, string_types) for key in keys)
+    if header is None and (byname(columns or []) or isinstance(schema, Mapping) and byname(schema)):
+        header=next(reader, None)
+        if header is None:
+            return
+    parse=None
+    for row in reader:
+        if parse is None:
+            wanted=list(columns) if columns is not None else list(range(1, len(header or row)+1))
+            indexes=[]
+            for column in wanted:
+                if not isinstance(column, string_types):
+                    indexes.append(column-1)
+                elif column in header:
+                    indexes.append(header.index(column))
+                else:
+                    raise ValueError('There is no column called %s in %s' % (column, header))
+            for index in indexes:
+                if index<0 or header and index>=len(header):
+                    raise ValueError('There is no column %d in %s (columns are numbered from 1)' % (index+1, header or row))
+            needed=max(indexes)+1 if indexes else 0
+            fieldnames=[header[index] if header else None for index in indexes]
+            if isinstance(schema, Mapping):
+                types=[schema.get(name, schema.get(index+1, str)) for index, name in zip(indexes, fieldnames)]
+            else:
+                types=list(schema) if schema is not None else [str]*len(indexes)
+                if len(types)!=len(indexes):
+                    raise ValueError('schema has %d types but there are %d columns' % (len(types), len(indexes)))
+            make=namedtuple('Row', fieldnames, rename=True) if header else None
+            parse=_rowparser(indexes, [_csvtypes.get(t, t) for t in types], make)
+        if len(row)<needed:
+            raise ValueError('Not enough items in row %s to pick columns %s' % (row, columns))
+        yield parse(row)
 
 @connector
-def csvread(fname=None, encoding=None, dialect='excel', n=0, names=None, skip=0, restkey=None, restval=None, tokens=None, **fmtparams):
+def csvread(fname=None, encoding=None, dialect='excel', n=0, names=None, skip=0, restkey=None, restval=None, columns=None,
+            schema=None, tokens=None, **fmtparams):
     """
     Reads a file or stream and parses it as a csv file using a :py:func:`csv.reader`. If names is set, uses a :py:func:`csv.DictReader`
 
@@ -1022,6 +3236,20 @@ def csvread(fname=None, encoding=None, dialect='excel', n=0, names=None, skip=0,
     North
     West
 
+    If ``columns`` or ``schema`` are set, each row is passed on as a ``tuple`` of just those columns, converted to the
+    types in the ``schema`` as they are read (which is a lot quicker than making a ``dict`` for each row and then using
+    ``convert``). If the columns have names (from ``names``, or if any columns are given by name, from the header row),
+    rows are passed on as ``namedtuple``\ s instead. Empty fields in a column with a type are passed on as ``None``
+
+    >>> from datetime import date
+    >>> data=['Region,Revenue,Cost,Date', 'North,10,5.5,2016-01-01', 'West,15,,2016-02-01']
+    >>> for row in csvread(columns=['Date', 'Region', 'Cost'], schema={'Cost': float, 'Date': date}, tokens=data):
+    ...     print(row)
+    Row(Date=datetime.date(2016, 1, 1), Region='North', Cost=5.5)
+    Row(Date=datetime.date(2016, 2, 1), Region='West', Cost=None)
+    >>> csvread(skip=1, columns=[2, 3], schema=[int, float], tokens=data) | aslist()
+    [(10, 5.5), (15, None)]
+
     :param fname: filename to read from - if None, reads from the stream
     :param encoding: encoding to use to read the file (warning: the csv module in python 2 does not support unicode 
         encoding - if you run into trouble I suggest reading the file with ``read`` then passing the output through the 
@@ -1032,10 +3260,20 @@ def csvread(fname=None, encoding=None, dialect='excel', n=0, names=None, skip=0,
     :param skip: rows to skip (e.g. header rows) before reading data
     :param restkey: (see the restkey keyword arg of :py:func:`csv.DictReader`)
     :param restval: (see the restval keyword arg of :py:func:`csv.DictReader`)
+    :param columns: the columns to pass on, as column numbers (starting at 1) or names (from ``names`` or the header row)
+    :param schema: the types (or functions) to convert columns to, as a ``list`` with one for each column in ``columns`` (or
+        in the file if ``columns`` isn't set), or a ``dict`` of column name or number to type. ``str`` means no conversion,
+        and ``datetime.date`` and ``datetime.datetime`` convert from ISO 8601 format
     :param fmtparams: see :py:func:`csv.reader`
     """
     import csv
     with _eopen(fname, encoding) if fname else _noopcontext(tokens) as f:
+        if columns is not None or schema is not None:
+            if n:
+                raise ValueError('n cannot be used with columns or schema - use columns instead')
+            for row in _typedrows(csv.reader(islice(f, skip, None), dialect, **fmtparams), columns, schema, names):
+                yield row
+            return
         reader = csv.reader(islice(f, skip, None), dialect, **fmtparams) if (n or not names) else csv.DictReader(islice(f, skip, None), names, restkey, restval, dialect, **fmtparams)
         for row in reader:
             if n:
@@ -1056,14 +3294,33 @@ def csvwrite(fname=None, mode='wb', encoding=None, dialect='excel', names=None,
     Region,Revenue,Cost
     North,5,3
     West,15,7
-
-    :param fname: filename or file-like object to write to - if None, uses stdout
+    >>> import os, tempfile
+    >>> fname=os.path.join(tempfile.mkdtemp(), 'regions.csv.bz2')
+    >>> [['North', 5, 3], ['West', 15, 7]] | csvwrite(fname)
+    >>> csvread(fname, schema=[str, int, int]) | aslist()
+    [('North', 5, 3), ('West', 15, 7)]
+    >>> os.remove(fname)
+
+    :param fname: filename or file-like object to write to - if None, uses stdout. Files ending in ``.gz``, ``.bz2`` or
+        ``.xz`` are compressed as they are written
     :param encoding: encoding to use to write the file
     :param names: the keys to use in the DictWriter
     """
     import csv
 
-    with open(fname, mode=mode, encoding=encoding) if fname and isinstance(fname, string_types) else _noopcontext(fname) if fname else _noopcontext(sys.stdout) as f:
+    if fname and isinstance(fname, string_types):
+        ext=os.path.splitext(fname)[1]
+        if PY3: # The csv module writes str, so needs a file opened in text mode without newline translation
+            mode=mode.replace('b', '').replace('t', '')+'t'
+            if ext in _compressors:
+                opener=closing(_compressedopen(fname, ext, mode, encoding, newline=''))
+            else:
+                opener=open(fname, mode=mode, encoding=encoding, newline='')
+        else: # pragma: no cover
+            opener=closing(_compressedopen(fname, ext, mode)) if ext in _compressors else open(fname, mode=mode)
+    else:
+        opener=_noopcontext(fname) if fname else _noopcontext(sys.stdout)
+    with opener as f:
         if names:
             writer=csv.DictWriter(f, fieldnames=names, restval=restval, extrasaction=extrasaction, **fmtparams)
             if not PY3 and sys.version_info[1]==6: # pragma: no cover
@@ -1072,47 +3329,169 @@ def csvwrite(fname=None, mode='wb', encoding=None, dialect='excel', names=None,
                 writer.writeheader()
         else:
             writer=csv.writer(f, dialect=dialect, **fmtparams)
-        for token in tokens: 
-            writer.writerow(token)
+        writer.writerows(tokens)
+
+def _compressedwrite(fname, ext, mode, encoding, level, threads, blocksize, buffersize, newlines, tokens):
+    """Writes tokens ``buffersize`` at a time to ``fname``, compressing them in background threads"""
+    tokens=iter(tokens)
+    first=next(tokens, _nothing)
+    if isinstance(first, bytes) and 'b' not in mode: # Write bytes without encoding them
+        mode, encoding=mode.replace('t', '')+'b', None
+    with closing(_compressedopen(fname, ext, mode, encoding, level, threads, blocksize)) as f:
+        _writechunks(f, ichain([first], tokens) if first is not _nothing else tokens, buffersize, newlines)
+
+@terminator
+def gzwrite(fname=None, mode='wt', encoding=None, level=9, threads=None, blocksize=1<<20, buffersize=1000, newlines=False, tokens=None):
+    r"""
+    Writes the stream to a gzip file (or to standard output if ``fname`` is ``None``). The output is cut into blocks of
+    ``blocksize`` bytes which are compressed into separate gzip members in ``threads`` background threads (by default,
+    one per core), so compression doesn't hold up the pipeline and uses all the cores available. Any gzip reader
+    (including ``gzread`` and ``gunzip``) reads the members back as one file. ``write`` and ``>`` use ``gzwrite`` for
+    files ending in ``.gz``
+
+    >>> import os, tempfile
+    >>> fname=os.path.join(tempfile.mkdtemp(), 'numbers.txt.gz')
+    >>> range(10000) | smap(str) | gzwrite(fname, threads=2, blocksize=1000, newlines=True)
+    >>> gzread(fname) | smap(int) | ssum()
+    49995000
+    >>> [b'Three\n', b'Blind\n', b'Mice\n'] | gzwrite(fname, mode='at')
+    >>> gzread(fname, binary=True) | tail(2) | aslist()==[b'Blind\n', b'Mice\n']
+    True
+    >>> os.remove(fname)
+
+    :param fname: If `str`, filename to write to, otherwise open binary file-like object to write to. Default of
+                    `None` implies write to standard output
+    :param mode: 'wt' to create a new file or 'at' to append to an existing one (use 'wb' or 'ab' to write ``bytes``)
+    :param encoding: Encoding to use to write the file
+    :param level: Compression level from 1 (fastest) to 9 (smallest)
+    :param threads: Number of threads to compress blocks in (default is the number of cores)
+    :param blocksize: Number of bytes to compress into each gzip member
+    :param buffersize: The number of tokens to write at once
+    :param newlines: If True, add a newline to the end of each token that doesn't already end with one
+    :param tokens: Lines to write to the file
+    """
+    _compressedwrite(fname, '.gz', mode, encoding, level, threads, blocksize, buffersize, newlines, tokens)
+
+@terminator
+def bzwrite(fname=None, mode='wt', encoding=None, level=9, threads=None, blocksize=900000, buffersize=1000, newlines=False, tokens=None):
+    r"""
+    Writes the stream to a bzip2 file (or to standard output if ``fname`` is ``None``), compressing blocks of
+    ``blocksize`` bytes into separate bzip2 streams in ``threads`` background threads like ``gzwrite``. ``write`` and
+    ``>`` use ``bzwrite`` for files ending in ``.bz2``. ``bzip2``, ``bzread`` and ``read`` read all of the streams, but
+    some readers stop at the end of the first one (e.g. :py:class:`bz2.BZ2File` before python 3.3) - set ``blocksize``
+    to more than the size of the output to write a single stream for them
+
+    >>> import os, tempfile
+    >>> fname=os.path.join(tempfile.mkdtemp(), 'numbers.txt.bz2')
+    >>> range(10000) | smap(str) | bzwrite(fname, threads=2, blocksize=1000, newlines=True)
+    >>> bzread(fname) | smap(int) | ssum()
+    49995000
+    >>> os.remove(fname)
+
+    :param fname: If `str`, filename to write to, otherwise open binary file-like object to write to. Default of
+                    `None` implies write to standard output
+    :param mode: 'wt' to create a new file or 'at' to append to an existing one (use 'wb' or 'ab' to write ``bytes``)
+    :param encoding: Encoding to use to write the file
+    :param level: Compression level from 1 (fastest) to 9 (smallest)
+    :param threads: Number of threads to compress blocks in (default is the number of cores)
+    :param blocksize: Number of bytes to compress into each bzip2 stream
+    :param buffersize: The number of tokens to write at once
+    :param newlines: If True, add a newline to the end of each token that doesn't already end with one
+    :param tokens: Lines to write to the file
+    """
+    _compressedwrite(fname, '.bz2', mode, encoding, level, threads, blocksize, buffersize, newlines, tokens)
+
+@terminator
+def xzwrite(fname=None, mode='wt', encoding=None, level=6, threads=None, blocksize=1<<22, buffersize=1000, newlines=False, tokens=None):
+    r"""
+    Writes the stream to an xz file (or to standard output if ``fname`` is ``None``), compressing blocks of
+    ``blocksize`` bytes into separate xz streams in ``threads`` background threads like ``gzwrite``. ``write`` and
+    ``>`` use ``xzwrite`` for files ending in ``.xz``
+
+    >>> import os, shutil, tempfile
+    >>> try:
+    ...     import lzma
+    ... except ImportError:
+    ...     try:
+    ...         from backports import lzma
+    ...     except ImportError: # Neither lzma nor backports.lzma is installed
+    ...         lzma=None
+    >>> d=tempfile.mkdtemp()
+    >>> fname=os.path.join(d, 'numbers.txt.xz')
+    >>> lzma is None or (range(10000) | smap(str) | xzwrite(fname, threads=2, blocksize=1000, newlines=True)) is None
+    True
+    >>> lzma is None or read(fname) | smap(int) | ssum()==49995000
+    True
+    >>> shutil.rmtree(d)
+
+    :param fname: If `str`, filename to write to, otherwise open binary file-like object to write to. Default of
+                    `None` implies write to standard output
+    :param mode: 'wt' to create a new file or 'at' to append to an existing one (use 'wb' or 'ab' to write ``bytes``)
+    :param encoding: Encoding to use to write the file
+    :param level: Compression preset from 0 (fastest) to 9 (smallest)
+    :param threads: Number of threads to compress blocks in (default is the number of cores)
+    :param blocksize: Number of bytes to compress into each xz stream
+    :param buffersize: The number of tokens to write at once
+    :param newlines: If True, add a newline to the end of each token that doesn't already end with one
+    :param tokens: Lines to write to the file
+    """
+    _compressedwrite(fname, '.xz', mode, encoding, level, threads, blocksize, buffersize, newlines, tokens)
 
 @connector
-def bzread(fname=None, encoding=None, tokens=None):
+def bzread(fname=None, encoding=None, binary=False, prefetch=0, progress=None, tokens=None):
     """
-    Read a file or files from bzip2-ed archives and output the lines within the files.
+    Read a file or files from bzip2-ed archives and output the lines within the files. If ``prefetch`` is set,
+    decompression runs in a background thread which keeps up to ``prefetch`` decompressed blocks ready, so that
+    decompressing the file and processing its lines can happen at the same time on separate cores (to decompress several
+    files at once, use ``pmap``)
 
     >>> find('examples/NASA*.bz2') | bzread() | head(1) | write()
     199.72.81.55 - - [01/Jul/1995:00:00:01 -0400] "GET /history/apollo/ HTTP/1.0" 200 6245
+    >>> bzread('examples/NASA_access_log_July95.log.bz2', prefetch=4) | count()
+    10000
 
     :param fname:  filename or ``list`` of filenames
     :param encoding: unicode encoding to use to open the file (if None, use platform default)
+    :param binary: If True, pass on the lines as ``bytes`` without decoding them
+    :param prefetch: If set, the number of blocks to decompress ahead in a background thread
+    :param progress: If ``True``, report progress through the files to standard error every second, or if a function,
+        call it with the progress instead (see ``progress``)
     :param tokens: list of filenames
     """
     files=_wrapInIterable(fname) if fname else tokens
-    openfunc=bz2.BZ2File if not PY3 or sys.version_info.minor<3 else bz2.open
-    for name in files:
-        with _wrappedopen(openfunc, name, encoding=encoding) as lines:
-            for line in lines:
-                yield line
+    return _readfiles(files, lambda name: _prefetched(_bz2open, name, encoding, binary, prefetch) if prefetch
+                                          else closing(_bz2open(name, mode='rb')) if binary
+                                          else _wrappedopen(_bz2open, name, encoding=encoding), progress, 'bzread')
 
 @connector
-def gzread(fname=None, encoding=None, tokens=None):
+def gzread(fname=None, encoding=None, binary=False, prefetch=0, progress=None, tokens=None):
     """
-    Read a file or files from gzip-ed archives and output the lines within the files.
+    Read a file or files from gzip-ed archives and output the lines within the files. If ``prefetch`` is set,
+    decompression runs in a background thread (see ``bzread``)
+
+    >>> gzread('examples/passwd.gz', binary=True) | matches(b'johndoe') | split([1,3], b':', b' ') | first() == b'johndoe 1000'
+    True
+    >>> gzread('examples/passwd.gz', prefetch=2) | matches('johndoe') | split([1,3], ':', ' ') | write()
+    johndoe 1000
 
     :param fname:  filename or ``list`` of filenames
     :param encoding: unicode encoding to use to open the file (if None, use platform default)
+    :param binary: If True, pass on the lines as ``bytes`` without decoding them
+    :param prefetch: If set, the number of blocks to decompress ahead in a background thread
+    :param progress: If ``True``, report progress through the files to standard error every second, or if a function,
+        call it with the progress instead (see ``progress``)
     :param tokens: list of filenames
     """
+    import gzip
     files=_wrapInIterable(fname) if fname else tokens
     if files is None:  #pragma: no cover
         raise ValueError('No filename or stream supplied')
-    for name in files:
-        with _wrappedopen(gzip.open, name, encoding=encoding) as lines:
-            for line in lines:
-                yield line
+    return _readfiles(files, lambda name: _prefetched(gzip.open, name, encoding, binary, prefetch) if prefetch
+                                          else closing(gzip.open(name, mode='rb')) if binary
+                                          else _wrappedopen(gzip.open, name, encoding=encoding), progress, 'gzread')
 
 @connector
-def read(fname=None, encoding=None, skip=0, tokens=None):
+def read(fname=None, encoding=None, skip=0, binary=False, prefetch=0, progress=None, tokens=None):
     """
     Read a file or files and output the lines it contains. Files are opened with :py:func:`io.read`
 
@@ -1120,21 +3499,28 @@ def read(fname=None, encoding=None, skip=0, tokens=None):
     >>> read('https://raw.github.com/maxgrenderjones/streamutils/master/README.md') | search('^[-] Source Code: (.*)', 1) | write()
     http://github.com/maxgrenderjones/streamutils
 
+    If ``binary`` is ``True``, lines are passed on as ``bytes`` without being decoded, which saves time if you don't
+    need unicode (e.g. when searching ASCII log files). Use ``bytes`` patterns and separators to process them
+
+    >>> read('examples/passwd.gz', binary=True) | search(b'^(\w+):x:(\d+)', group=None) | aslist() == [[b'root', b'0'], [b'johndoe', b'1000']]
+    True
+
     :param fname: filename or ``list`` of filenames. Can either be paths to local files or URLs (e.g. http:// or ftp:// - supports the same protocols as :py:func:`urllib2.urlopen`)
     :param encoding: encoding to use to open the file (if None, use platform default)
     :param skip: number of lines to skip at the beginning of each file
+    :param binary: If True, pass on the lines as ``bytes`` without decoding them
+    :param prefetch: If set, local files are read (and decompressed) in a background thread which keeps up to
+        ``prefetch`` blocks ready (see ``bzread``)
+    :param progress: If ``True``, report progress through the files to standard error every second, or if a function,
+        call it with the progress instead (see ``progress``)
     :param tokens: list of filenames
     """
     if fname or tokens:
         files=_wrapInIterable(fname) if fname else tokens
-        for name in files:
-            with _eopen(name, encoding) as f:
-                for line in islice(f, skip, None):
-                    yield line
+        return _readfiles(files, lambda name: _eopen(name, encoding, binary, prefetch), progress, 'read', skip)
     else:  #pragma: no cover
         import fileinput
-        for line in fileinput.input('-'):
-            yield line
+        return fileinput.input('-', mode='rb' if binary else 'r')
 
 @connector
 def search(pattern, group=0, to=None, match=False, fname=None, encoding=None, names=None, inject={}, flags=0,
@@ -1159,7 +3545,7 @@ def search(pattern, group=0, to=None, match=False, fname=None, encoding=None, na
     >>> search(r'(Dwarf \w+\s*){7}', to='The Seven Dwarves', tokens=['%s and %s' % (sw, dwarves)]) | write()
     Snow White and The Seven Dwarves
 
-    :param pattern: Pattern to look for
+    :param pattern: Pattern to look for (a string, or a regexp compiled with :py:func:`re.compile`)
     :param group: Group (``int``) or groups (``list`` of `int`s or match names) to return. (Note: 0 returns the whole match,
             None returns the matches in a group as a list)
     :param to: Regexp substition pattern to return - uses :py:func:`re.sub`
@@ -1172,13 +3558,13 @@ def search(pattern, group=0, to=None, match=False, fname=None, encoding=None, na
     :param flags: Regexp flags to use
     :param tokens: strings to search through
     """
-    matcher=re.compile(pattern) if not flags else re.compile(pattern, flags=flags)
+    matcher=_compile(pattern, flags)
     if fname is not None:
         tokens=read(fname, encoding)
     for line in tokens:
         result=matcher.match(line) if match else matcher.search(line)
         if not result and strict:
-            raise ValueError('%s does not match pattern %s' % (line, pattern))
+            raise ValueError('%s does not match pattern %s' % (line, matcher.pattern))
         if to:
             if match:
                 if result:
@@ -1189,6 +3575,17 @@ def search(pattern, group=0, to=None, match=False, fname=None, encoding=None, na
             if result:
                 yield _groupstodict(result, group, names, inject)
 
+@_kernel(search)
+def _searchkernel(pattern, group=0, to=None, match=False, fname=None, encoding=None, names=None, inject={}, flags=0,
+                  strict=False):
+    if fname is not None or strict or (to and match):
+        return None
+    matcher=_compile(pattern, flags)
+    if to:
+        return [('map', partial(matcher.sub, to))]
+    return [('map', matcher.match if match else matcher.search), ('filter', None),
+            ('map', lambda result: _groupstodict(result, group, names, inject))]
+
 @connector
 def replace(old, new, tokens=None):
     """
@@ -1201,6 +3598,10 @@ def replace(old, new, tokens=None):
     for line in tokens:
         yield line.replace(old, new)
 
+@_kernel(replace)
+def _replacekernel(old, new):
+    return [('map', methodcaller('replace', old, new))]
+
 @connector
 def matches(pattern, match=False, flags=0, v=False, tokens=None):
     """
@@ -1210,23 +3611,33 @@ def matches(pattern, match=False, flags=0, v=False, tokens=None):
     >>> matches('A', tokens=months) | write()
     April
     August
+    >>> import re
+    >>> months | matches(re.compile('^ju', re.IGNORECASE)) | write()
+    June
+    July
 
-    :param pattern: regexp pattern to test against
+    :param pattern: regexp pattern to test against (a string, or a regexp compiled with :py:func:`re.compile`)
     :param match: if ``True``, use :py:func:`re.match` else use :py:func:`re.search` (default ``False``)
     :param flags: regexp flags
     :param v: if ``True``, return strings that don't match (think UNIX ``grep -v``) (default ``False``)
     :param tokens: strings to match
     """
-    matcher=re.compile(pattern) if not flags else re.compile(pattern, flags=flags)
+    matcher=_compile(pattern, flags)
     #print 'tokens type %s' %  type(tokens)
     for line in tokens:
         #print 'Running line %s (type: %s) against %s' % (line, type(line), pattern)
-        assert isinstance(line, string_types)
+        assert isinstance(line, string_types) or isinstance(line, bytes)
         result=matcher.match(line) if match else matcher.search(line)
         if result and not v:
             yield line
         elif v and not result:
             yield line
+
+@_kernel(matches)
+def _matcheskernel(pattern, match=False, flags=0, v=False):
+    matcher=_compile(pattern, flags)
+    return [('filterfalse' if v else 'filter', matcher.match if match else matcher.search)]
+
 @connector
 def nomatch(pattern, match=False, flags=0, tokens=None):
     """
@@ -1238,13 +3649,247 @@ def nomatch(pattern, match=False, flags=0, tokens=None):
     June
     July
 
-    :param pattern: regexp pattern to test against
+    :param pattern: regexp pattern to test against (a string, or a regexp compiled with :py:func:`re.compile`)
     :param match: if ``True``, use :py:func:`re.match` else use :py:func:`re.search` (default ``False``)
     :param flags: regexp flags
     :param tokens: strings to match
     """
-    for token in matches(pattern=pattern, flags=flags, match=match, v=True, tokens=tokens):
-        yield token
+    matcher=_compile(pattern, flags)
+    for line in tokens:
+        if not (matcher.match(line) if match else matcher.search(line)):
+            yield line
+
+@_kernel(nomatch)
+def _nomatchkernel(pattern, match=False, flags=0):
+    matcher=_compile(pattern, flags)
+    return [('filterfalse', matcher.match if match else matcher.search)]
+
+class _AhoCorasick(object):
+    """
+    An Aho-Corasick automaton, which finds which of a set of literal strings occur in a string in a single pass through
+    it, however many strings there are
+
+    >>> automaton=_AhoCorasick(['he', 'she', 'his', 'hers'])
+    >>> sorted(automaton.findall('ushers'))
+    [0, 1, 3]
+    >>> automaton.search('this'), automaton.search('hurts')
+    (True, False)
+    """
+    def __init__(self, words):
+        self.goto, self.fail, self.out=[{}], [0], [()]
+        self.empty=tuple(i for i, word in enumerate(words) if not word)
+        for i, word in enumerate(words):
+            state=0
+            for c in word:
+                if c not in self.goto[state]:
+                    self.goto[state][c]=len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state=self.goto[state][c]
+            self.out[state]+=(i,)
+        queue=deque(self.goto[0].values())
+        while queue:
+            parent=queue.popleft()
+            for c, state in self.goto[parent].items():
+                queue.append(state)
+                fail=self.fail[parent]
+                while fail and c not in self.goto[fail]:
+                    fail=self.fail[fail]
+                self.fail[state]=self.goto[fail].get(c, 0)
+                self.out[state]+=self.out[self.fail[state]]
+
+    def search(self, text):
+        """Returns whether any of the words occur in ``text``"""
+        if self.empty:
+            return True
+        goto, fail, out=self.goto, self.fail, self.out
+        state=0
+        for c in text:
+            while state and c not in goto[state]:
+                state=fail[state]
+            state=goto[state].get(c, 0)
+            if out[state]:
+                return True
+        return False
+
+    def findall(self, text):
+        """Returns the ``set`` of the indexes of the words that occur in ``text``"""
+        goto, fail, out=self.goto, self.fail, self.out
+        found=set(self.empty)
+        state=0
+        for c in text:
+            while state and c not in goto[state]:
+                state=fail[state]
+            state=goto[state].get(c, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+def _requiredliteral(pattern, flags=0):
+    r"""
+    Returns the longest literal string that every match of a regexp pattern must contain (or ``None`` if there isn't one
+    that can be worked out), and whether the pattern matches exactly that string and nothing else
+
+    >>> _requiredliteral(r'GET /admin/\d+ HTTP')
+    ('GET /admin/', False)
+    >>> _requiredliteral('Grumpy')
+    ('Grumpy', True)
+    >>> _requiredliteral('Doc|Dopey'), _requiredliteral('Doc|Happy'), _requiredliteral('Doc', flags=re.IGNORECASE)
+    (('Do', False), (None, False), (None, False))
+    """
+    try:
+        from re import _parser as sre_parse
+    except ImportError: # pragma: no cover - python < 3.11
+        import sre_parse
+    try:
+        parsed=sre_parse.parse(pattern, flags)
+    except Exception: # pragma: no cover - let re report the error
+        return None, False
+    state=getattr(parsed, 'state', None) or parsed.pattern
+    if (flags | state.flags) & (re.IGNORECASE | re.LOCALE):
+        return None, False
+    runs=[[]]
+    def walk(items):
+        for op, av in items:
+            if op==sre_parse.LITERAL:
+                runs[-1].append(av)
+            elif op==sre_parse.SUBPATTERN and not (len(av)==4 and av[1] & re.IGNORECASE):
+                walk(av[-1])
+            else:
+                runs.append([])
+    walk(parsed)
+    exact=len(runs)==1
+    run=max(runs, key=len)
+    if not run:
+        return None, False
+    return (bytes(bytearray(run)) if isinstance(pattern, bytes) else u''.join(map(unichr, run))), exact
+
+class _MultiMatcher(object):
+    """
+    Matches strings against a list of patterns at once (used by ``matchesany`` and ``searchany``). Patterns that are
+    plain literals are found with an Aho-Corasick automaton (or :py:meth:`str.startswith` if ``match`` is True). For the
+    other patterns, the longest literal that every match must contain is found with a second automaton, so that a
+    pattern's regexp is only run against strings that contain its literal
+    """
+    def __init__(self, patterns, match=False, flags=0, literal=False):
+        self.match=match
+        self.regexps=[]
+        exact, required, self.requiredby, self.always=[], [], [], []
+        for i, pattern in enumerate(patterns):
+            self.regexps.append(_compile(re.escape(pattern) if literal else pattern, flags))
+            if literal and not flags & (re.IGNORECASE | re.LOCALE): # Otherwise the automatons wouldn't match the same
+                text, isexact=pattern, True
+            else:
+                text, isexact=_requiredliteral(self.regexps[-1].pattern, self.regexps[-1].flags)
+            if isexact:
+                exact.append(text)
+            elif text is not None:
+                required.append(text)
+                self.requiredby.append(i)
+            else:
+                self.always.append(i)
+        self.exactindexes=[i for i, pattern in enumerate(patterns) if i not in self.requiredby and i not in self.always]
+        self.prefixes=tuple(exact) if match and exact else None
+        self.exact=_AhoCorasick(exact) if exact and not match else None
+        self.required=_AhoCorasick(required) if required else None
+
+    def __call__(self, line):
+        """Returns whether any of the patterns match ``line``"""
+        if self.prefixes and line.startswith(self.prefixes) or self.exact and self.exact.search(line):
+            return True
+        for i in self.always:
+            if (self.regexps[i].match if self.match else self.regexps[i].search)(line):
+                return True
+        if self.required:
+            for j in self.required.findall(line):
+                if (self.regexps[self.requiredby[j]].match if self.match else self.regexps[self.requiredby[j]].search)(line):
+                    return True
+        return False
+
+    def first(self, line):
+        """Returns the match object for the first of the patterns (in the order given) that matches ``line``, or ``None``"""
+        candidates=set(self.always)
+        if self.prefixes:
+            candidates.update(i for i, prefix in zip(self.exactindexes, self.prefixes) if line.startswith(prefix))
+        if self.exact:
+            candidates.update(self.exactindexes[j] for j in self.exact.findall(line))
+        if self.required:
+            candidates.update(self.requiredby[j] for j in self.required.findall(line))
+        for i in sorted(candidates):
+            result=self.regexps[i].match(line) if self.match else self.regexps[i].search(line)
+            if result:
+                return result
+        return None
+
+@connector
+def matchesany(patterns, match=False, flags=0, v=False, literal=False, tokens=None):
+    r"""
+    Filters the input for strings that match any of a list of patterns. This gives the same result as joining the
+    patterns with ``|`` and calling ``matches``, but is much faster when there are many patterns, as each string is
+    scanned once for all the literal strings in the patterns (using the Aho-Corasick algorithm), and a regexp pattern is
+    only tried against strings that contain the literal text that every match of it must contain
+
+    >>> blocked=['doubleclick.net', 'tracker.example', 'ads.example.com']
+    >>> requests=['GET http://ads.example.com/banner', 'GET http://example.com/', 'GET http://tracker.example/pixel']
+    >>> requests | matchesany(blocked, literal=True) | write()
+    GET http://ads.example.com/banner
+    GET http://tracker.example/pixel
+    >>> requests | matchesany([r'\.com/', 'GET http://ex'], v=True) | write()
+    GET http://tracker.example/pixel
+    >>> ['an ERROR here', 'all fine'] | matchesany(['error', 'failed'], literal=True, flags=re.I) | write()
+    an ERROR here
+
+    :param patterns: ``list`` of regexp patterns or compiled regexps (or, if ``literal`` is True, strings) to test against
+    :param match: if ``True``, use :py:func:`re.match` else use :py:func:`re.search` (default ``False``)
+    :param flags: regexp flags
+    :param v: if ``True``, return strings that don't match any of the patterns (default ``False``)
+    :param literal: if ``True``, the patterns are plain strings to look for, not regexps
+    :param tokens: strings to match
+    """
+    matcher=_MultiMatcher(patterns, match, flags, literal)
+    for line in tokens:
+        if matcher(line)!=v:
+            yield line
+
+@_kernel(matchesany)
+def _matchesanykernel(patterns, match=False, flags=0, v=False, literal=False):
+    return [('filterfalse' if v else 'filter', _MultiMatcher(patterns, match, flags, literal))]
+
+@connector
+def searchany(patterns, group=0, match=False, flags=0, names=None, inject={}, literal=False, tokens=None):
+    r"""
+    Looks for each of a list of regexp patterns within each token, and for the first pattern (in the order given) that
+    is found, passes on the match or a group (as for ``search``). Strings that contain none of the patterns are dropped.
+    Like ``matchesany``, this only tries the regexps that could match each token, so is fast for many patterns
+
+    >>> lines=['Error: disk full', 'Warning: 12 retries', 'Info: started']
+    >>> lines | searchany([r'Warning: (\d+)', 'Error: (.*)'], group=1) | write()
+    disk full
+    12
+    >>> lines | searchany(['error', 'WARNING'], literal=True, flags=re.I) | write()
+    Error
+    Warning
+
+    :param patterns: ``list`` of regexp patterns or compiled regexps (or, if ``literal`` is True, strings) to look for
+    :param group: Group (``int``) or groups (``list`` of `int`s or match names) to return (see ``search``)
+    :param match: If ``False`` (default) use :py:func:`re.search` elif ``True`` use :py:func:`re.match`
+    :param flags: Regexp flags to use
+    :param names: dict of groups to names - if included, result will be a dict
+    :param inject: Used in conjunction with names, a ``dict`` of key: values to inject into the results dictionary
+    :param literal: if ``True``, the patterns are plain strings to look for, not regexps
+    :param tokens: strings to search through
+    """
+    matcher=_MultiMatcher(patterns, match, flags, literal)
+    for line in tokens:
+        result=matcher.first(line)
+        if result:
+            yield _groupstodict(result, group, names, inject)
+
+@_kernel(searchany)
+def _searchanykernel(patterns, group=0, match=False, flags=0, names=None, inject={}, literal=False):
+    return [('map', _MultiMatcher(patterns, match, flags, literal).first), ('filter', None),
+            ('map', lambda result: _groupstodict(result, group, names, inject))]
 
 @connector
 def fnmatches(pathpattern, matchcase=False, tokens=None):
@@ -1276,7 +3921,7 @@ def fnmatches(pathpattern, matchcase=False, tokens=None):
         elif not matchcase and fnmatch.fnmatch(line, pathpattern):
             yield line
 @connector
-def find(pathpattern=None, tokens=None):
+def find(pathpattern=None, progress=None, tokens=None):
     """
     Searches for files the match a given pattern. For example
 
@@ -1287,14 +3932,17 @@ def find(pathpattern=None, tokens=None):
     src/streamutils/version.py
 
     :param str pathpattern: :py:func:`glob.glob`-style pattern
+    :param progress: If ``True``, report how many files have been found to standard error every second, or if a
+        function, call it with the progress instead (see ``progress``)
     :param tokens: A list of ``glob``-style patterns to search for
     :return: An iterator across the filenames found by the function
     """
     paths=_wrapInIterable(pathpattern) if pathpattern else tokens
     if paths:
-        return ichain.from_iterable(glob.iglob(path) for path in paths)
+        found=ichain.from_iterable(glob.iglob(path) for path in paths)
     else:
-        return glob.iglob('**/*')
+        found=glob.iglob('**/*')
+    return _metered(found, _Progress('find', progress, sizes=False)) if progress else found
 
 @connector
 def words(n=0, word=r'\S+', outsep=None, names=None, inject=None, flags=0, tokens=None):
@@ -1326,7 +3974,7 @@ def words(n=0, word=r'\S+', outsep=None, names=None, inject=None, flags=0, token
     :param n: an integer indicating which word to return (first word is 1), a list of integers to select multiple words, or 0 to return all words. If
         n is an integer, the result is a string, if n is a list, the result is a list of strings
     :type n: int or list
-    :param str word: a pattern that will be used to select words using :py:func:`re.findall` - (default \S+)
+    :param str word: a pattern (or compiled regexp) that will be used to select words using :py:func:`re.findall` - (default \S+)
     :param str outsep: a string separator to join together the words that are found into a new string (or None to output a list of words)
     :param names: (Optional) a name or list of names of the n extracted words, used to construct a dict to be passed down the pipeline
     :type names: str or list
@@ -1335,7 +3983,7 @@ def words(n=0, word=r'\S+', outsep=None, names=None, inject=None, flags=0, token
     :param tokens: list of tokens to iterate through in the function (usually supplied by the previous function in the pipeline)
     :raise: ``ValueError`` if there are less than n (or max(n)) words in the string
     """
-    matcher=re.compile(word) if not flags else re.compile(word, flags=flags)
+    matcher=_compile(word, flags)
     for line in tokens:
         result=matcher.findall(line)
         yield _ntodict(result, n, names, inject) if not outsep else outsep.join(_ntodict(result, n, names, inject))
@@ -1360,6 +4008,16 @@ def split(n=0, sep=None, outsep=None, names=None, inject={}, tokens=None):
     for line in tokens:
         result=line.split(sep)
         yield _ntodict(result, n, names, inject) if not outsep else outsep.join(_ntodict(result, n, names, inject))
+
+@_kernel(split)
+def _splitkernel(n=0, sep=None, outsep=None, names=None, inject={}):
+    if not (n or names or outsep):
+        return [('map', methodcaller('split', sep))]
+    def splitter(line):
+        result=line.split(sep)
+        return _ntodict(result, n, names, inject) if not outsep else outsep.join(_ntodict(result, n, names, inject))
+    return [('map', splitter)]
+
 @connector
 def join(sep=' ', tokens=None):
     r"""
@@ -1373,6 +4031,10 @@ def join(sep=' ', tokens=None):
     for line in tokens:
         yield sep.join(line)
 
+@_kernel(join)
+def _joinkernel(sep=' '):
+    return [('map', sep.join)]
+
 @connector
 def update(values=None, funcs=None, tokens=None):
     """
@@ -1474,6 +4136,115 @@ def smap(*funcs, **kwargs): #python 3.x will let you write smap(*funcs, tokens=N
     """
     return map(reduce(lambda f, g: lambda x: f(g(x)), funcs), kwargs['tokens'])
 
+@_kernel(smap)
+def _smapkernel(*funcs):
+    return [('map', func) for func in reversed(funcs)]
+
+@connector
+def pmap(func, processes=None, ordered=True, chunksize=1, tokens=None):
+    """
+    Applies a function to each element of the stream in a pool of worker processes (see :py:class:`multiprocessing.Pool`).
+    Typically the stream is a list of filenames (e.g. from ``find``) and ``func`` runs a pipeline over one file and returns
+    its result, so that files are processed on all available cores. ``func`` (and the tokens and results) must be
+    picklable, so should be a module-level function, not a ``lambda``. Results of mergeable terminators can then be
+    combined e.g. with ``ssum`` for counts or ``sreduce`` for ``bag``-s
+
+    >>> from streamutils import *
+    >>> files = find('examples/passwd*') | ssorted()
+    >>> sizes = files | pmap(os.path.getsize, processes=2) | aslist()
+    >>> sizes == [os.path.getsize(f) for f in files]
+    True
+    >>> files | pmap(os.path.getsize, processes=2, ordered=False) | ssum() == sum(sizes)
+    True
+
+    :param func: Picklable function to apply to each token
+    :param processes: Number of worker processes to use (default: the number of CPUs)
+    :param ordered: If ``True`` (the default), results are passed on in the order of the tokens, otherwise in the order
+        in which they complete
+    :param chunksize: Number of tokens to send to a worker at a time
+    :param tokens: Picklable things to pass to ``func`` (e.g. filenames)
+    """
+    import multiprocessing
+    pool=multiprocessing.Pool(processes)
+    try:
+        for result in (pool.imap if ordered else pool.imap_unordered)(func, tokens, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _byteranges(fname, n):
+    """
+    Splits a file into (up to) ``n`` ranges of roughly equal numbers of bytes, each of which starts at the beginning of a line
+
+    >>> ranges=_byteranges('ez_setup.py', 4)
+    >>> ranges[0][0]==0 and ranges[-1][1]==os.path.getsize('ez_setup.py')
+    True
+    >>> all(a[1]==b[0] for a, b in zip(ranges, ranges[1:]))
+    True
+    """
+    size=os.path.getsize(fname)
+    bounds=[0]
+    with open(fname, 'rb') as f:
+        for i in range(1, n):
+            f.seek(max(size*i//n, bounds[-1]))
+            f.readline()
+            if f.tell()>=size:
+                break
+            if f.tell()>bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end>start]
+
+def _rangelines(fname, start, end, encoding):
+    """Yields the (decoded) lines of a file that start within a range of bytes"""
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        pos=start
+        for line in f:
+            if pos>=end:
+                break
+            pos+=len(line)
+            line=line.decode(encoding)
+            yield line[:-2]+'\n' if line.endswith('\r\n') else line
+
+def _scanrange(func, encoding, byterange):
+    fname, start, end=byterange
+    return func(_rangelines(fname, start, end, encoding))
+
+@connector
+def pscan(func, fname=None, processes=None, chunks=None, encoding=None, tokens=None):
+    """
+    Scans a large (uncompressed) file in parallel. The file is split into ``chunks`` ranges of bytes aligned to the
+    beginning of lines, and ``func`` is called in a pool of worker processes with an iterator over the lines in each
+    range. The results of each call are passed on in order, so typically ``func`` runs a pipeline over the lines and
+    returns a mergeable result (a count, a ``bag``, a ``list`` of matching lines) which can then be combined. As with
+    ``pmap``, ``func`` and its results must be picklable (so should be a module-level function, not a ``lambda``)
+
+    >>> from streamutils import *
+    >>> pscan(list, 'ez_setup.py', processes=2, chunks=7) | separate() | aslist() == read('ez_setup.py') | aslist()
+    True
+    >>> from collections import Counter
+    >>> pscan(Counter, 'ez_setup.py', processes=2) | ssum(Counter()) == read('ez_setup.py') | bag()
+    True
+
+    :param func: Picklable function that takes an iterator of lines and returns a picklable result
+    :param fname: Filename (or list of filenames) to scan
+    :param processes: Number of worker processes to use (default: the number of CPUs)
+    :param chunks: Number of ranges to split each file into (default: the number of CPUs)
+    :param encoding: Encoding to use to read the file (if None, use platform default)
+    :param tokens: list of filenames to scan
+    """
+    import multiprocessing
+    chunks=chunks or processes or multiprocessing.cpu_count()
+    files=_wrapInIterable(fname) if fname else tokens
+    ranges=[(name, start, end) for name in files for start, end in _byteranges(name, chunks)]
+    results=pmap(partial(_scanrange, func, _encoding(encoding)), processes, tokens=ranges)
+    with closing(results):
+        for result in results:
+            yield result
+
 @connector
 def strip(chars=None, tokens=None):
     r"""
@@ -1488,6 +4259,10 @@ def strip(chars=None, tokens=None):
     """
     return map(lambda x: x.strip(chars), tokens)
 
+@_kernel(strip)
+def _stripkernel(chars=None):
+    return [('map', methodcaller('strip', chars))]
+
 @connector
 def sfilter(func=None, tokens=None):
     """
@@ -1509,6 +4284,10 @@ def sfilter(func=None, tokens=None):
     """
     return filter(func, tokens)
 
+@_kernel(sfilter)
+def _sfilterkernel(func=None):
+    return [('filter', func)]
+
 @connector
 def sfilterfalse(func=None, tokens=None):
     """
@@ -1635,18 +4414,128 @@ def combine(func=None, tokens=None):
         if agg:
             yield agg
 
-def merge(left, right, on, how='inner', join=tuple):
+def _joinkey(val, on):
+    """Returns the value to join on: the attribute called ``on`` if there is one, otherwise ``val[on]``"""
+    return getattr(val, on) if isinstance(on, string_types) and hasattr(val, on) else val[on]
+
+def _joined(join, left, right):
+    return (left, right) if join==tuple else join(left, right)
+
+def _spill(items, on, partitions, level):
+    """Writes ``items`` out to ``partitions`` temporary files, partitioned by a hash of the value they are joined on"""
+    import tempfile
+    from six.moves import cPickle as pickle
+    files=[tempfile.TemporaryFile() for i in range(partitions)]
+    for val in items:
+        pickle.dump(val, files[hash((level, _joinkey(val, on)))%partitions], pickle.HIGHEST_PROTOCOL)
+    for f in files:
+        f.seek(0)
+    return files
+
+def _unspill(f):
+    """Yields the items written to a temporary file by ``_spill``"""
+    from six.moves import cPickle as pickle
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+_MERGEPARTITIONS = 16 # How many partitions to split the inputs into each time merge runs out of memory
+_MERGELEVELS = 4 # After this many rounds of partitioning, the rest of a partition is joined in memory
+
+def _hashjoin(build, probe, on, buildleft, keepbuild, keepprobe, join, buffersize, level=0):
+    """
+    Joins two iterables by reading ``build`` into a ``dict`` then streaming ``probe`` past it. If there are more than
+    ``buffersize`` items in ``build``, both sides are hash partitioned into temporary files and each partition is
+    joined in turn (a grace hash join)
+    """
+    index=OrderedDict()
+    build=iter(build)
+    for n, val in enumerate(build):
+        index.setdefault(_joinkey(val, on), []).append(val)
+        if buffersize and n>=buffersize and level<_MERGELEVELS:
+            buildfiles=_spill(ichain(ichain.from_iterable(index.values()), build), on, _MERGEPARTITIONS, level)
+            index=None
+            probefiles=_spill(probe, on, _MERGEPARTITIONS, level)
+            for buildfile, probefile in zip(buildfiles, probefiles):
+                with closing(buildfile), closing(probefile):
+                    for result in _hashjoin(_unspill(buildfile), _unspill(probefile), on, buildleft, keepbuild,
+                                            keepprobe, join, buffersize, level+1):
+                        yield result
+            return
+    matched=set()
+    for val in probe:
+        key=_joinkey(val, on)
+        if key in index:
+            if keepbuild:
+                matched.add(key)
+            for other in index[key]:
+                yield _joined(join, other, val) if buildleft else _joined(join, val, other)
+        elif keepprobe:
+            yield _joined(join, None, val) if buildleft else _joined(join, val, None)
+    if keepbuild:
+        for key, others in index.items():
+            if key not in matched:
+                for other in others:
+                    yield _joined(join, other, None) if buildleft else _joined(join, None, other)
+
+def _sortedgroups(items, on, side):
+    """Groups items that are sorted by the value they are joined on, checking that they really are sorted"""
+    previous=_nothing
+    for key, group in igroupby(items, key=lambda val: _joinkey(val, on)):
+        if previous is not _nothing and key<previous:
+            raise ValueError('The %s sequence is not sorted on %s (%r comes after %r)' % (side, on, key, previous))
+        previous=key
+        yield key, group
+
+def _sortmergejoin(left, right, on, keepleft, keepright, join):
+    """Joins two iterables that are both sorted on the value they are joined on, holding one group of each in memory"""
+    lefts, rights=_sortedgroups(left, on, 'left'), _sortedgroups(right, on, 'right')
+    lkey, lgroup=next(lefts, (_nothing, None))
+    rkey, rgroup=next(rights, (_nothing, None))
+    while lkey is not _nothing or rkey is not _nothing:
+        if lkey is not _nothing and rkey is not _nothing and lkey==rkey:
+            rgroup=list(rgroup)
+            for val in lgroup:
+                for other in rgroup:
+                    yield _joined(join, val, other)
+            lkey, lgroup=next(lefts, (_nothing, None))
+            rkey, rgroup=next(rights, (_nothing, None))
+        elif rkey is _nothing or lkey is not _nothing and lkey<rkey:
+            if keepleft:
+                for val in lgroup:
+                    yield _joined(join, val, None)
+            lkey, lgroup=next(lefts, (_nothing, None))
+        else:
+            if keepright:
+                for other in rgroup:
+                    yield _joined(join, None, other)
+            rkey, rgroup=next(rights, (_nothing, None))
+
+def merge(left, right, on, how='inner', join=tuple, buffersize=None, presorted=False):
     r"""
     Merges two sequences together (think `JOIN` in `SQL`). For a left join, the right sequence is read
     into memory then joined to the left sequence (so left sequence determines the order) and vice versa.
-    For an inner join, the right sequence is read into memory (so should be the shorter of the two).
+    For an inner or outer join, the right sequence is read into memory (so should be the shorter of the two), and for an
+    outer join the items in the right sequence that didn't match anything come last.
+
+    If the sequence that is read into memory has more than ``buffersize`` items, both sequences are instead split into
+    partitions by (a hash of) the value they are joined on and written to temporary files, and then the partitions are
+    joined one at a time (a grace hash join), so the results come out grouped by partition rather than in order. If both
+    sequences are already sorted on ``on``, pass ``presorted=True`` to join them as they are read, holding only one group
+    of items with the same ``on`` value from each in memory (a sort-merge join)
 
     :param left: Sequence of items that should be placed on the left
     :param right: Sequence of items that should be placed on the right
     :param on: `dict` key or attribute to join on
-    :param how: One of `inner`, `left`, `right` (`outer` not yet implemented)
+    :param how: One of `inner`, `left`, `right` or `outer`
     :param join: Either `tuple` in which results are `yield`-ed as tuples of (leftval, rightval) or a function
         in which case values are `yield`-ed as `join(leftval, rightval)`
+    :param buffersize: The maximum number of items to hold in memory before partitioning to disk (``None`` for no limit).
+        Items must be picklable to be written to disk
+    :param presorted: If ``True``, both sequences are sorted on ``on``, so can be joined without reading either into memory
+        (a ``ValueError`` is raised if they turn out not to be)
 
     >>> dogs=[{'Name': 'Fido', 'Owner': 'Bob'}, {'Name': 'Rover', 'Owner': 'John'}]
     >>> cats=[{'Name': 'Tiddles', 'Owner': 'John'}, {'Name': 'Fluffy', 'Owner': 'Steve'}]
@@ -1659,25 +4548,21 @@ def merge(left, right, on, how='inner', join=tuple):
     >>> result = merge(dogs, cats, on='Owner', how='right') | aslist()
     >>> result == [({'Name': 'Rover', 'Owner': 'John'}, {'Name': 'Tiddles', 'Owner': 'John'}), (None, {'Name': 'Fluffy', 'Owner': 'Steve'})]
     True
+    >>> merge(dogs, cats, on='Owner', how='outer', presorted=True, join=lambda d, c: (d or c)['Owner']) | aslist()
+    ['Bob', 'John', 'Steve']
+    >>> owners=lambda d, c: (d and d['Name'], c and c['Name'])
+    >>> merge(dogs*1000, cats*1000, on='Owner', how='outer', join=owners, buffersize=100) | bag() == \
+    ...     merge(dogs*1000, cats*1000, on='Owner', how='outer', join=owners) | bag()
+    True
     """
-    if how not in ['left', 'right', 'inner']:
+    if how not in ['left', 'right', 'inner', 'outer']:
         raise NotImplementedError('Merge method {how} not implemented'.format(**locals())) #pragma: no cover
-    index=defaultdict(list)
-    for val in right if how in ['left', 'inner'] else left:
-        index[getattr(val, on, val[on])].append(val)
-    for val in left if how in ['left', 'inner'] else right:
-        onval = getattr(val, on, val[on])
-        if onval in index:
-            for other in index[onval]:
-                if join==tuple:
-                    yield tuple([val, other]) if how in ['left', 'inner'] else tuple([other, val])
-                else:
-                    yield join(val, other) if how in ['left', 'inner'] else join(other, val)
-        elif how in ['left', 'right']:
-            if join==tuple:
-                yield tuple([val, None]) if how=='left' else tuple([None, val])
-            else:
-                yield tuple([val, None]) if how=='right' else tuple([None, val])
+    if presorted:
+        return _sortmergejoin(left, right, on, how in ['left', 'outer'], how in ['right', 'outer'], join)
+    elif how=='right':
+        return _hashjoin(left, right, on, True, False, True, join, buffersize)
+    else:
+        return _hashjoin(right, left, on, False, how=='outer', how in ['left', 'outer'], join, buffersize)
 
 @connector
 def sformat(pattern, tokens=None):
@@ -1698,9 +4583,16 @@ def sformat(pattern, tokens=None):
     :param tokens: list of lists of fomatting arguments or list of mappings
     """
     for token in tokens:
-        if isinstance(token, Sequence):
-            yield pattern.format(*token)
-        elif isinstance(token, Mapping):
-            yield pattern.format(*token.values(), **token)
-        else:  # pragma: no cover
-            raise TypeError('Format expects a sequence or a mapping - got a %s' % type(token))
+        yield _format(pattern, token)
+
+def _format(pattern, token):
+    if isinstance(token, Sequence):
+        return pattern.format(*token)
+    elif isinstance(token, Mapping):
+        return pattern.format(*token.values(), **token)
+    else:  # pragma: no cover
+        raise TypeError('Format expects a sequence or a mapping - got a %s' % type(token))
+
+@_kernel(sformat)
+def _sformatkernel(pattern):
+    return [('map', partial(_format, pattern))]
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs a streamutils pipeline from the shell, so that it can take the place of ``awk``, ``grep`` or ``cut`` in a shell
+pipeline::
+
+    $ streamutils "matches('johndoe') | split([1, 3], ':')" /etc/passwd
+    $ zcat access.log.gz | python -m streamutils "search(r'^([\\w.-]+)') | bag()"
+
+The expression is the rest of a pipeline, which is fed the lines of the files named after it (compressed files are
+decompressed as they are read), or of standard input if there aren't any. Everything that ``from streamutils import *``
+imports (and the ``re``, ``os``, ``sys`` and ``math`` modules) can be used in it. If the pipeline passes on tokens,
+they are written to standard output, otherwise the result of its terminator is printed.
+
+With ``-j``, the lines are split up and each part is run through the pipeline in a separate worker process. Tokens are
+passed on in order. A terminator is only allowed if it is built on an ``Accumulator`` (``count``, ``ssum``, ``smax``,
+``smin``, ``bag``, ``countby``, ``nlargest``, ``nsmallest``, ``sumby``, ``meanby`` or ``accumulate``), so that the
+state from each worker can be merged into one result. Stages that depend on the whole stream rather than a line at a
+time (e.g. ``head``, ``tail``, ``unique``, ``window`` or ``ssorted``) would only see their own part of it, so aren't
+allowed either.
+"""
+
+from __future__ import print_function, division
+
+import sys, os, copy, errno, argparse
+from functools import partial
+from itertools import islice
+from six.moves import reduce
+
+import streamutils
+from streamutils import Connector, Terminator, Accumulator, read, write, pmap, pscan, profile, accumulate
+
+# The Accumulator that each terminator is built on, to be made with the same arguments so that the state from each worker
+# can be merged under -j
+_accumulators={'count': streamutils.Count, 'ssum': streamutils.Sum, 'smax': streamutils.Max, 'smin': streamutils.Min,
+               'bag': streamutils.Bag, 'countby': streamutils.CountBy, 'nlargest': streamutils.NLargest,
+               'nsmallest': streamutils.NSmallest, 'sumby': streamutils.SumBy, 'meanby': streamutils.MeanBy,
+               'accumulate': lambda accumulator: accumulator}
+
+# Connectors that depend on the whole stream (or its position in it), so would give a different answer for each part
+_stateful=('head', 'tail', 'sslice', 'unique', 'window', 'extsort', 'takewhile', 'dropwhile', 'combine', 'csvread', 'run')
+
+def _namespace(tokens, parallel=False):
+    """
+    Returns the names that can be used in a pipeline expression, with ``tokens`` as ``__tokens__``. If ``parallel`` is
+    set, terminators end the pipeline with their ``Accumulator`` instead, and stages that can't be run in parts raise a
+    ``ValueError``
+    """
+    import re, math
+    namespace=dict((name, getattr(streamutils, name)) for name in streamutils.__all__)
+    if parallel:
+        for name, func in list(namespace.items()):
+            if name in _accumulators:
+                namespace[name]=partial(_accumulating, _accumulators[name])
+            elif name in _stateful or isinstance(func, Terminator):
+                namespace[name]=partial(_unparallel, name, isinstance(func, Terminator))
+    namespace.update(re=re, os=os, sys=sys, math=math, __tokens__=tokens)
+    return namespace
+
+def _accumulating(accumulator, *args, **kwargs):
+    return accumulate(accumulator(*args, **kwargs))
+
+def _unparallel(name, terminator, *args, **kwargs):
+    if terminator:
+        raise ValueError("-j can't combine the results of %s() from each worker (only terminators built on an "
+                         "Accumulator can be: %s)" % (name, ', '.join(sorted(_accumulators))))
+    raise ValueError("-j can't run %s() on each part of the stream separately" % name)
+
+def _evaluate(expression, tokens, parallel=False):
+    """Runs ``tokens`` through the pipeline ``expression``, returning a ``Connector`` if it doesn't end in a terminator"""
+    return eval('__tokens__ | '+expression if tokens is not None else expression, _namespace(tokens, parallel))
+
+def _state(accumulator):
+    """The state of an ``Accumulator`` without any functions it was made with, which might not be picklable"""
+    return dict((name, value) for name, value in vars(accumulator).items() if not callable(value))
+
+def _runlines(expression, lines):
+    """Runs some lines through the pipeline ``expression`` in a worker process, returning its tokens or state"""
+    result=_evaluate(expression, lines, parallel=True)
+    return ('tokens', list(result)) if isinstance(result, Connector) else ('state', _state(result))
+
+def _chunks(tokens, chunksize):
+    tokens=iter(tokens)
+    while True:
+        chunk=list(islice(tokens, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def _stdin(encoding=None, binary=False):
+    """Returns standard input, reading ``bytes`` if ``binary`` is set or decoding it with ``encoding`` if supplied"""
+    stdin=getattr(sys.stdin, 'buffer', sys.stdin)
+    if binary:
+        return stdin
+    if encoding:
+        from io import TextIOWrapper
+        return TextIOWrapper(stdin, encoding=encoding)
+    return sys.stdin
+
+def _parallel(args, results):
+    """
+    Runs the pipeline in ``args.jobs`` worker processes, yielding the tokens it passes on in order, and adding the
+    state of the accumulator of its terminator in each worker (if it ends in one) to ``results``
+    """
+    expression=args.expression
+    plain=args.files and not args.binary and '-' not in args.files and \
+          all(os.path.splitext(name)[1] not in ('.gz', '.gzip', '.bz2', '.xz') for name in args.files)
+    if plain: # Workers read their own parts of the files
+        parts=pscan(partial(_runlines, expression), args.files, processes=args.jobs, encoding=args.encoding)
+    else:
+        parts=pmap(partial(_runlines, expression), processes=args.jobs,
+                   tokens=_chunks(_input(args), args.chunksize))
+    for kind, part in parts:
+        if kind=='tokens':
+            for token in part:
+                yield token
+        else:
+            results.append(part)
+
+def _input(args):
+    if not args.files or args.files==['-']:
+        return _stdin(args.encoding, args.binary)
+    return read(args.files, encoding=args.encoding, binary=args.binary, prefetch=4)
+
+def _merge(total, state):
+    """Merges the state of an ``Accumulator`` from a worker into ``total`` (which has the functions it was made with)"""
+    other=copy.copy(total)
+    other.__dict__=dict(vars(total), **state)
+    return total.merge(other)
+
+def _run(args):
+    if args.jobs>1 and not args.noinput:
+        total=_evaluate(args.expression, [], parallel=True) # The accumulator to merge the workers' states into
+        results=[]
+        _parallel(args, results) | write(buffersize=args.buffersize)
+        result=reduce(_merge, results, total).result() if isinstance(total, Accumulator) else None
+    else:
+        result=_evaluate(args.expression, None if args.noinput else _input(args))
+        if isinstance(result, Connector):
+            result=result | write(buffersize=args.buffersize)
+    if result is not None:
+        print(result)
+
+def _parser():
+    parser=argparse.ArgumentParser(prog='streamutils', description='Runs a streamutils pipeline over the lines of '
+                                   'files (or standard input), e.g. streamutils "matches(\'error\') | count()" log.txt')
+    parser.add_argument('expression', help='The rest of the pipeline, e.g. "split([1, 3], \':\') | ssorted()"')
+    parser.add_argument('files', nargs='*', help='Files to read (default: standard input). Files ending in .gz, .bz2 '
+                        'or .xz are decompressed')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes to run the pipeline in')
+    parser.add_argument('-b', '--binary', action='store_true', help='Pass on the lines as bytes without decoding them')
+    parser.add_argument('-e', '--encoding', help='Encoding to use to read the lines (default: platform default)')
+    parser.add_argument('-n', '--no-input', dest='noinput', action='store_true',
+                        help="Don't read any lines: the expression is the whole pipeline, e.g. \"find('*.py') | count()\"")
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help='Report how long each stage of the pipeline takes to standard error')
+    parser.add_argument('--buffersize', type=int, help='Number of tokens to write out at once (default: 1000, or 1 when '
+                        'following files)')
+    parser.add_argument('--chunksize', type=int, default=10000, help='Number of lines to send to a worker at once')
+    return parser
+
+def main(argv=None):
+    r"""
+    Runs a pipeline from the command line (see ``docs/cookbook.rst`` for examples). Returns the exit status
+
+    :param argv: The command line arguments (default: ``sys.argv[1:]``)
+    """
+    parser=_parser()
+    args=parser.parse_args(argv)
+    if args.jobs>1 and not args.noinput:
+        try:
+            _evaluate(args.expression, [], parallel=True)
+        except ValueError as e:
+            parser.error(str(e))
+    try:
+        if args.profile:
+            with profile() as p:
+                _run(args)
+            sys.stderr.write(p.report()+'\n')
+        else:
+            _run(args)
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno!=errno.EPIPE:
+            raise
+        # Whatever we were writing to (e.g. head) has stopped reading, so stop quietly like other unix tools
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# coding: utf-8
+# vim: set tabstop=4 shiftwidth=4 expandtab:
+"""
+Support for using streamutils pipelines from ``asyncio`` code (python 3.6+ only). Any pipeline can be iterated over with
+``async for``, and the asynchronous sources here (``afollow``, ``arun`` and ``aread``) can start a pipeline, so that a
+single event loop can tail many files and commands at once:
+
+ *  If a pipeline starts with an asynchronous source and the rest of its stages act on one token at a time
+    (``matches``, ``search``, ``split``, ``replace``, ``strip``, ``join``, ``sformat``, ``smap``, ``sfilter``) it runs
+    entirely on the event loop
+ *  Otherwise the pipeline runs in a worker thread that passes the tokens back to the event loop (and waits for more to
+    be consumed before getting too far ahead), so that it never blocks the event loop
+ *  ``collect`` ends a pipeline with a ``Terminator`` without blocking the event loop
+ *  An asynchronous source can also be used in an ordinary pipeline, in which case it is run in an event loop of its own
+
+>>> import asyncio
+>>> from streamutils import *
+>>> from streamutils.aio import *
+>>> async def main():
+...     async for line in aread('examples/passwd') | matches('root') | split(sep=':', n=7) | strip():
+...         print(line)
+...     return await collect(arun('git --version') | search(r'git (version)', group=1), first())
+>>> loop=asyncio.new_event_loop()
+>>> loop.run_until_complete(main())
+/bin/bash
+'version'
+>>> loop.close()
+"""
+
+from __future__ import print_function, division
+
+import asyncio, locale, shlex, subprocess, threading
+
+from contextlib import closing
+from functools import update_wrapper
+
+from . import Connector, _Follower, _compilesteps, _live, _stagekernel, aslist, read
+
+__all__ = ['aiterate', 'asource', 'afollow', 'arun', 'aread', 'collect']
+
+_local = threading.local() # Holds the event loop that asynchronous sources in a worker thread's pipeline run on
+_end = object() # Sentinel for the end of the tokens from a worker thread
+
+class AsyncSource(Connector):
+    """
+    A ``Connector`` whose function is an asynchronous generator. Iterating over it with ``async for`` runs the generator
+    on the current event loop. Iterating over it normally runs it on the event loop of the ``aiterate`` that is running the
+    pipeline in a worker thread if there is one, or else on a new event loop
+    """
+    def __iter__(self):
+        self.it=_syncagen(self.func())
+        return self.it
+
+async def _anext(agen):
+    return await agen.__anext__()
+
+def _syncagen(agen):
+    """Iterates over an asynchronous generator from synchronous code"""
+    loop=getattr(_local, 'loop', None)
+    own=loop is None
+    if own:
+        loop=asyncio.new_event_loop()
+        wait=loop.run_until_complete
+    else:
+        wait=lambda coro: asyncio.run_coroutine_threadsafe(coro, loop).result()
+    try:
+        while True:
+            try:
+                token=wait(_anext(agen))
+            except StopAsyncIteration:
+                return
+            yield token
+    finally:
+        if own:
+            try:
+                loop.run_until_complete(agen.aclose())
+            finally:
+                loop.close()
+        elif not loop.is_closed():
+            wait(agen.aclose())
+
+def asource(func):
+    """
+    Decorator used to wrap an asynchronous generator function in an ``AsyncSource`` so that it can start a pipeline
+
+    :param func: The asynchronous generator function to be wrapped
+    """
+    return update_wrapper(AsyncSource(func), func)
+
+def _produce(loop, tokens, queue, slots, stopping):
+    """
+    Iterates over a pipeline in a worker thread, passing each token to ``queue`` on the event loop. Once ``stopping`` is
+    set (because the consumer has been closed) it stops at the next token and closes the pipeline
+    """
+    _local.loop=loop
+    item=(_end, None)
+    try:
+        for token in tokens:
+            if stopping.is_set():
+                return
+            slots.acquire()
+            if stopping.is_set():
+                return
+            loop.call_soon_threadsafe(queue.put_nowait, (token, None))
+    except Exception as e:
+        item=(_end, e)
+    finally:
+        _local.loop=None
+        if hasattr(tokens, 'close'):
+            tokens.close()
+    if not stopping.is_set():
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+async def _threaded(tokens, maxsize):
+    loop=asyncio.get_event_loop()
+    queue=asyncio.Queue()
+    slots=threading.Semaphore(maxsize)
+    stopping=threading.Event()
+    producer=threading.Thread(target=_produce, args=(loop, tokens, queue, slots, stopping))
+    producer.daemon=True
+    producer.start()
+    try:
+        while True:
+            token, error=await queue.get()
+            slots.release()
+            if token is _end:
+                if error is not None:
+                    raise error
+                return
+            yield token
+    finally:
+        stopping.set()
+        slots.release()
+
+async def _fused(source, steps):
+    fused=_compilesteps(steps) if steps else None
+    tokens=source.func()
+    try:
+        async for token in tokens:
+            if fused is None:
+                yield token
+            else:
+                for token in fused(tokens=(token,)):
+                    yield token
+    finally:
+        await tokens.aclose()
+
+def aiterate(tokens, maxsize=64):
+    """
+    Returns an asynchronous iterator over the tokens from a pipeline (this is what ``async for`` calls). Pipelines that
+    start with an ``AsyncSource`` followed by per-token stages run on the event loop, others run in a worker thread
+
+    >>> import asyncio
+    >>> from streamutils import *
+    >>> async def main():
+    ...     return [line async for line in aiterate(['Happy', 'Sneezy', 'Dopey'] | head(2), maxsize=1)]
+    >>> loop=asyncio.new_event_loop()
+    >>> loop.run_until_complete(main())
+    ['Happy', 'Sneezy']
+    >>> loop.close()
+
+    :param tokens: The pipeline (or other iterable) to iterate over
+    :param maxsize: The number of tokens that a worker thread can get ahead of the code iterating over them
+    """
+    steps=[]
+    stage=tokens
+    while isinstance(stage, Connector) and not isinstance(stage, AsyncSource) and stage.it is None:
+        kernel=_stagekernel(stage.func, stage.tokenskw)
+        if kernel is None:
+            break
+        steps[0:0]=kernel
+        stage=stage.func.keywords[stage.tokenskw]
+    if isinstance(stage, AsyncSource) and stage.it is None:
+        return _fused(stage, steps)
+    return _threaded(tokens, maxsize)
+
+async def collect(tokens, terminator=None):
+    """
+    Ends a pipeline with a ``Terminator`` (``aslist`` by default) in a worker thread, so that the event loop isn't blocked
+    while it waits for the result
+
+    >>> import asyncio
+    >>> from streamutils import *
+    >>> loop=asyncio.new_event_loop()
+    >>> loop.run_until_complete(collect(read('examples/passwd') | matches('sh$'), count()))
+    2
+    >>> loop.close()
+
+    :param tokens: The pipeline to end
+    :param terminator: The ``Terminator`` to end it with
+    """
+    terminator=terminator or aslist()
+    loop=asyncio.get_event_loop()
+    def end():
+        _local.loop=loop
+        try:
+            return tokens | terminator
+        finally:
+            _local.loop=None
+    return await loop.run_in_executor(None, end)
+
+async def _changed(follower):
+    """Waits on the event loop until one of the files being followed might have changed"""
+    if follower.fileno() is None:
+        await asyncio.sleep(follower.delay)
+        return
+    loop=asyncio.get_event_loop()
+    readable=asyncio.Event()
+    loop.add_reader(follower.fileno(), readable.set)
+    try:
+        deadline=loop.time()+follower.interval
+        while loop.time()<deadline:
+            try:
+                await asyncio.wait_for(readable.wait(), deadline-loop.time())
+            except asyncio.TimeoutError:
+                return
+            readable.clear()
+            if follower.changed():
+                return
+    finally:
+        loop.remove_reader(follower.fileno())
+
+@asource
+async def afollow(fname, encoding=None, interval=1):
+    """
+    Asynchronous version of ``follow``, which waits on the event loop for new lines to be added to a file (or files)
+    rather than blocking. On linux, the event loop waits on inotify, so following a file doesn't need a thread of its own
+    (Note: Never finishes)
+
+    >>> import asyncio, os, tempfile
+    >>> from streamutils import *
+    >>> fd, fname=tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> async def main():
+    ...     lines=aiterate(afollow(fname, interval=0.01) | strip())
+    ...     following=asyncio.ensure_future(lines.__anext__())
+    ...     await asyncio.sleep(0.1)
+    ...     with open(fname, 'a') as f:
+    ...         f.write('Doc\\nBashful\\n')
+    ...     print(await following, await lines.__anext__())
+    ...     await lines.aclose()
+    >>> loop=asyncio.new_event_loop()
+    >>> loop.run_until_complete(main())
+    Doc Bashful
+    >>> loop.close()
+    >>> os.remove(fname)
+
+    :param fname: File (or ``list`` of files, or glob pattern) to read
+    :param encoding: encoding to use to read the file
+    :param interval: maximum number of seconds to wait before checking the files again
+    """
+    with closing(_Follower(fname, encoding, interval)) as follower:
+        while True:
+            lines=follower.poll()
+            for line in lines:
+                yield line
+            if not lines:
+                await _changed(follower)
+
+_live.add(afollow.func)
+
+async def _afeed(stdin, tokens, encoding):
+    """
+    Writes tokens to the standard input of a process and then closes it. Tokens that can't be iterated over with
+    ``async for`` are read in a worker thread, so that waiting for them doesn't block the event loop
+    """
+    tokens=tokens.__aiter__() if hasattr(tokens, '__aiter__') else _threaded(tokens, 64)
+    try:
+        async for token in tokens:
+            stdin.write(token if encoding is None else token.encode(encoding))
+            await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError): # The process has just stopped reading
+        pass
+    finally:
+        stdin.close()
+        if hasattr(tokens, 'aclose'):
+            await tokens.aclose()
+
+@asource
+async def arun(command, err=False, cwd=None, env=None, binary=False, check=False, tokens=None):
+    r"""
+    Asynchronous version of ``run``, which runs a command as a subprocess of the event loop. Tokens are written to its
+    standard input by a separate task (reading them in a worker thread unless they come from an asynchronous source), and
+    if the stream is closed before the command finishes, the command is terminated
+
+    >>> import asyncio, sys
+    >>> from streamutils import *
+    >>> upper=[sys.executable, '-c', 'import sys; sys.stdout.write(sys.stdin.read().upper())']
+    >>> async def main():
+    ...     return [line async for line in ['Happy\n', 'Grumpy\n'] | arun(upper) | strip()]
+    >>> loop=asyncio.new_event_loop()
+    >>> loop.run_until_complete(main())
+    ['HAPPY', 'GRUMPY']
+    >>> loop.close()
+
+    :param command: Command to run as a string or list
+    :param err: Redirect standard error to standard out (default False)
+    :param cwd: Current working directory for command
+    :param env: Environment to pass into command
+    :param binary: If True, pass on the output as ``bytes`` without decoding it (tokens should then be ``bytes`` too)
+    :param check: If True, raise a :py:class:`subprocess.CalledProcessError` at the end of the stream if the command
+        exits with a non-zero exit status
+    :param tokens: Lines to pass into the command as standard in (a pipeline, which can start with an asynchronous source)
+    """
+    if isinstance(command, str):
+        command=shlex.split(command)
+    encoding=None if binary else locale.getpreferredencoding(False)
+    proc=await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env,
+                                              stdin=None if tokens is None else subprocess.PIPE,
+                                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT if err else None)
+    feeder=None if tokens is None else asyncio.ensure_future(_afeed(proc.stdin, tokens, encoding))
+    decode=(lambda line: line) if binary else (lambda line: line.decode(encoding).replace('\r\n', '\n'))
+    finished=False
+    try:
+        rest=b''
+        while True:
+            block=await proc.stdout.read(1<<16)
+            if not block:
+                break
+            lines=(rest+block).split(b'\n')
+            rest=lines.pop()
+            for line in lines:
+                yield decode(line+b'\n')
+        if rest:
+            yield decode(rest)
+        finished=True
+    finally:
+        if not finished and proc.returncode is None:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+            while await proc.stdout.read(1<<16): # The process only counts as finished once its output has been read
+                pass
+        if feeder is not None and not finished:
+            feeder.cancel()
+        await proc.wait()
+    if feeder is not None:
+        await feeder
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+@asource
+async def aread(fname=None, encoding=None, skip=0, binary=False, prefetch=0, tokens=None):
+    """
+    Asynchronous version of ``read``, which reads files (or URLs) in a worker thread so that waiting on the disk or the
+    network doesn't block the event loop
+
+    :param fname: filename or ``list`` of filenames. Can either be paths to local files or URLs (e.g. http:// or ftp://)
+    :param encoding: encoding to use to open the file (if None, use platform default)
+    :param skip: number of lines to skip at the beginning of each file
+    :param binary: If True, read the files without decoding them and pass on ``bytes``
+    :param prefetch: number of blocks to read ahead of the pipeline in a background thread (see ``read``)
+    :param tokens: list of filenames
+    """
+    async for line in _threaded(read(fname, encoding, skip, binary, prefetch, tokens=tokens), 64):
+        yield line